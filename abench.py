@@ -0,0 +1,262 @@
+""" A very simple in-process benchmark for gae-json-rest's utilities.
+
+Unlike atest.py this needs no running server: it sets up a local datastore
+stub, so it only needs the GAE SDK, whose directory path must be given with
+-l (just as for the -l option of testutil's Tester).  Each benchmark reports
+a rate "before" (a reference implementation of how things used to be done)
+and "after" (what jsonutil does now).  Benchmarks in SDK_FREE (e.g. codecs,
+which compares codecutil's JSON backends) run without the SDK, too.
+"""
+import optparse
+import os
+import sys
+import time
+
+APP_ID = 'gae-json-rest'
+
+
+def setup_sdk(gaepath):
+  """ Make the SDK importable and hook up the needed API stubs. """
+  gaepath = os.path.realpath(gaepath)
+  sys.path[0:0] = [gaepath,
+                   os.path.join(gaepath, 'lib', 'django'),
+                   os.path.join(gaepath, 'lib', 'webob'),
+                   os.path.join(gaepath, 'lib', 'yaml', 'lib'),
+                  ]
+  os.environ['APPLICATION_ID'] = APP_ID
+  from google.appengine.api import apiproxy_stub_map
+  from google.appengine.api import datastore_file_stub
+  from google.appengine.api.memcache import memcache_stub
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3',
+      datastore_file_stub.DatastoreFileStub(APP_ID, None, None))
+  apiproxy_stub_map.apiproxy.RegisterStub('memcache',
+      memcache_stub.MemcacheStub())
+
+
+def rate(f, count, repeat=3):
+  """ Best-of-repeat rate, in items/sec, of f() processing count items. """
+  best = None
+  for i in range(repeat):
+    start = time.time()
+    f()
+    elapsed = time.time() - start
+    if best is None or elapsed < best: best = elapsed
+  return count / max(best, 1e-6)
+
+
+def report(title, before, after, unit):
+  print '%s:' % title
+  print '  before: %12.0f %s' % (before, unit)
+  print '  after:  %12.0f %s  (x%.2f)' % (after, unit, after / before)
+
+
+def make_wide_model(num_props):
+  """ Make, register and decorate a model with many string properties. """
+  from google.appengine.ext import db
+  import restutil
+  attrs = dict(('p%02d' % i, db.StringProperty()) for i in range(num_props))
+  model = type('Wide%d' % num_props, (db.Model,), attrs)
+  restutil.registerClassByName(model)
+  restutil.addHelperMethods(model)
+  return model
+
+
+def put_wide_entities(model, count, size):
+  """ Make and put count entities of model, each string of length size. """
+  from google.appengine.ext import db
+  import restutil
+  names = [name for name, value in restutil.allProperties(model)]
+  entities = [model(**dict((name, 'x' * size) for name in names))
+              for i in range(count)]
+  db.put(entities)
+  return entities
+
+
+def _introspective_make_jobj(entity):
+  """ make_jobj as it was before serialization plans (for reference). """
+  import jsonutil
+  import restutil
+  model = type(entity)
+  jobj = jsonutil.id_of(entity)
+  props = restutil.allProperties(model)
+  for property_name, property_value in props:
+    value_in_entity = getattr(entity, property_name, None)
+    if value_in_entity is not None:
+      to_string = getattr(model, property_name + '_to_string')
+      jobj[property_name] = to_string(value_in_entity)
+  return jobj
+
+
+def bench_make_jobj(options):
+  import jsonutil
+  model = make_wide_model(20)
+  entities = put_wide_entities(model, options.count, 10)
+  def before():
+    for e in entities: _introspective_make_jobj(e)
+  def after():
+    for e in entities: jsonutil.make_jobj(e)
+  report('make_jobj, %d entities w/20 properties' % len(entities),
+         rate(before, len(entities)), rate(after, len(entities)),
+         'entities/sec')
+
+
+def bench_make_jobj_refs(options):
+  from google.appengine.ext import db
+  import jsonutil
+  import models
+  doctors = [models.Doctor(name='Dr. %d' % i) for i in range(options.count)]
+  db.put(doctors)
+  pagers = [models.Pager(number='555-%04d' % i, doctor=doctor)
+            for i, doctor in enumerate(doctors)]
+  db.put(pagers)
+  # fetch the pagers anew each time, so no dereferenced doctor is reused
+  def before():
+    for p in models.Pager.all().fetch(len(pagers)): _introspective_make_jobj(p)
+  def after():
+    for p in models.Pager.all().fetch(len(pagers)): jsonutil.make_jobj(p)
+  report('fetch + make_jobj, %d Pagers w/a Doctor each' % len(pagers),
+         rate(before, len(pagers)), rate(after, len(pagers)),
+         'entities/sec')
+
+
+def bench_encode_entity(options):
+  import jsonutil
+  model = make_wide_model(20)
+  entities = put_wide_entities(model, options.count, 10)
+  def before():
+    jsonutil.encode_json([jsonutil.make_jobj(e) for e in entities])
+  def after():
+    jsonutil.encode_entities(entities)
+  report('jobjs to JSON, %d entities w/20 properties' % len(entities),
+         rate(before, len(entities)), rate(after, len(entities)),
+         'entities/sec')
+
+
+def bench_list_ids(options):
+  import jsonutil
+  model = make_wide_model(20)
+  entities = put_wide_entities(model, options.count, 500)
+  def before():
+    jsonutil.encode_json([jsonutil.id_of(x) for x in model.all()])
+  def after():
+    keys, next_cursor = jsonutil.fetch_page(model.all(keys_only=True),
+                                            len(entities))
+    jsonutil.encode_ids(keys)
+  report('listing IDs, %d entities w/20 500-char properties' % len(entities),
+         rate(before, len(entities)), rate(after, len(entities)),
+         'entities/sec')
+
+
+def bench_codecs(options):
+  import codecutil
+  ids = [{'id': str(1000000 + i)} for i in range(options.count)]
+  jobjs = [{'id': str(1000000 + i), 'name': 'Dr. John %d' % i,
+            'number': '555-%04d' % i, 'doctor': 'Doctor/%d' % i}
+           for i in range(options.count)]
+  selected = codecutil.name
+  print 'JSON backends (selected: %s):' % selected
+  try:
+    for title, payload in (('id-only jobjs', ids), ('Pager jobjs', jobjs)):
+      text = codecutil.dumps(payload)
+      for name, module, accelerated in codecutil.backends():
+        codecutil.use(name)
+        print '  %-10s %-14s dumps: %9.0f, loads: %9.0f jobjs/sec%s' % (
+            name, title,
+            rate(lambda: codecutil.dumps(payload), len(payload)),
+            rate(lambda: codecutil.loads(text), len(payload)),
+            ('', ' (accelerated)')[accelerated])
+  finally:
+    codecutil.use(selected)
+
+
+def _bulk_body(count):
+  """ JSON text of a bulk POST of count Pager jobjs, as clients send it. """
+  import codecutil
+  return codecutil.dumps([{'number': '555-%04d' % i, 'doctor': 'Doctor/%d' % i}
+                          for i in range(count)])
+
+
+def bench_decoder(options):
+  import simplejson
+  from simplejson.decoder import JSONDecoder
+  body = _bulk_body(options.count)
+  slow = JSONDecoder(fast=False)
+  report('bundled simplejson, decoding a bulk body of %d jobjs' %
+         options.count, rate(lambda: slow.decode(body), options.count),
+         rate(lambda: simplejson.loads(body), options.count), 'jobjs/sec')
+
+
+def bench_encoder(options):
+  from simplejson.encoder import JSONEncoder
+  ids = [{'id': str(1000000 + i)} for i in range(options.count)]
+  jobjs = [{'id': str(1000000 + i), 'name': 'Dr. John %d' % i,
+            'number': '555-%04d' % i, 'doctor': 'Doctor/%d' % i}
+           for i in range(options.count)]
+  slow = JSONEncoder(fast=False)
+  fast = JSONEncoder(check_circular=False)
+  for title, payload in (('id-only', ids), ('Pager', jobjs)):
+    report('bundled simplejson, encoding %d %s jobjs' % (len(payload), title),
+           rate(lambda: slow.encode(payload), len(payload)),
+           rate(lambda: fast.encode(payload), len(payload)), 'jobjs/sec')
+
+
+class _Request(object):
+  """ Just enough of a request object for jsonutil's receive_* functions. """
+  def __init__(self, body):
+    self.body = body
+
+
+def bench_receive(options):
+  import codecutil
+  import jsonutil
+  import models
+  request = _Request(_bulk_body(options.count))
+  def before():
+    [jsonutil._parse(models.Pager, jobj, creating=True)
+     for jobj in codecutil.loads(request.body)]
+  def after():
+    jsonutil.receive_entity_dicts(request, models.Pager, creating=True)
+  report('decode + parse, bulk body of %d Pager jobjs' % options.count,
+         rate(before, options.count), rate(after, options.count),
+         'jobjs/sec')
+
+
+benchmarks = [
+  ('make_jobj', bench_make_jobj),
+  ('make_jobj_refs', bench_make_jobj_refs),
+  ('encode_entity', bench_encode_entity),
+  ('list_ids', bench_list_ids),
+  ('receive', bench_receive),
+  ('codecs', bench_codecs),
+  ('decoder', bench_decoder),
+  ('encoder', bench_encoder),
+]
+
+# benchmarks that need no GAE SDK
+SDK_FREE = ('codecs', 'decoder', 'encoder')
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [-l SDKPATH] [benchmark...]')
+  parser.add_option("-l", "--local-gae", action="store", dest="gaepath",
+                    help="GAE SDK directory path")
+  parser.add_option("-n", "--count", dest="count", default=1000,
+                    type="int", help="how many entities to use")
+  options, args = parser.parse_args()
+  names = [name for name, f in benchmarks]
+  for name in args:
+    if name not in names:
+      parser.error('Unknown benchmark %r (known: %s)' % (name,
+                   ', '.join(names)))
+  if options.gaepath is not None:
+    setup_sdk(options.gaepath)
+  elif not args or [name for name in args if name not in SDK_FREE]:
+    parser.error('the GAE SDK directory path (-l) is required')
+  for name, f in benchmarks:
+    if not args or name in args:
+      f(options)
+
+
+if __name__ == '__main__':
+  main()
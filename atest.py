@@ -1,6 +1,7 @@
 """ A very simple "smoke test" for gae-json-rest toy app. """
 import sys
-import simplejson
+import urllib
+import codecutil
 import testutil
 
 class TemplateTest(object):
@@ -21,7 +22,7 @@ class TemplateTest(object):
 
     # do we know any Doctors?
     self.emit('IDs of Doctors before any operations:')
-    doctorids = tester.request_and_show('GET', '/Doctor/')
+    doctorids = tester.request_all_pages('/Doctor/')
     # get the highest-known Doctor ID, if any, to ensure a unique number
     if doctorids:
       unique = max(int(obj['id']) for obj in doctorids) + 1
@@ -35,7 +36,7 @@ class TemplateTest(object):
       tester.silent_request('DELETE', '/Doctor/%s' % strid)
       deletions += 1
     self.emit('IDs of Doctors after some deletions:')
-    doctorids = tester.silent_request('GET', '/Doctor/')
+    doctorids = tester.silent_request_all_pages('/Doctor/')
     self.emit(doctorids)
     if len(doctorids) != num_doctors - deletions:
       print 'Had %d doctors, deleted %d, should have %d but have %d' % (
@@ -48,6 +49,9 @@ class TemplateTest(object):
     # make entity with that name
     post_body = testutil.body(name=docname)
     post_result = tester.request_and_show('POST', '/Doctor/', post_body)
+    if post_result.get('name') != docname:
+      print 'POST should return the full new doctor, gave %r' % (post_result,)
+      sys.exit(1)
     new_doctor_id = post_result['id']
     new_doctor_path = '/Doctor/%s' % new_doctor_id
     self.emit('Created %r' % new_doctor_path)
@@ -60,7 +64,7 @@ class TemplateTest(object):
       sys.exit(1)
     # show IDs after the POST
     self.emit('IDs of Doctors after POST:')
-    doctorids = tester.request_and_show('GET', '/Doctor/')
+    doctorids = tester.request_all_pages('/Doctor/')
     if len(doctorids) != num_doctors + 1:
       print 'Had %d doctors, created %d, should have %d but have %d' % (
           num_doctors, 1, num_doctors+1, len(doctorids))
@@ -71,6 +75,10 @@ class TemplateTest(object):
     docname = '%s changed' % docname
     put_body = testutil.body(name=docname)
     put_result = tester.request_and_show('PUT', new_doctor_path, put_body)
+    if 'x-unchanged-ids' in tester.last_headers:
+      print 'Changing PUT should have no X-Unchanged-Ids, gave %r' % (
+          tester.last_headers['x-unchanged-ids'])
+      sys.exit(1)
     # show new doctor just changed
     self.emit('New Doctor just changed:')
     new_doctor = tester.request_and_show('GET', new_doctor_path)
@@ -79,7 +87,7 @@ class TemplateTest(object):
           docname, new_doctor['name'])
       sys.exit(1)
     self.emit('IDs of Doctors after PUT:')
-    doctorids = tester.request_and_show('GET', '/Doctor/')
+    doctorids = tester.request_all_pages('/Doctor/')
     if len(doctorids) != num_doctors:
       print 'Had %d doctors, put %d, should have %d but have %d' % (
           num_doctors, 1, num_doctors, len(doctorids))
@@ -88,6 +96,22 @@ class TemplateTest(object):
     # check idempotence of PUT
     self.emit('Check PUT idempotence')
     tester.request_and_show('PUT', new_doctor_path, put_body)
+    if not tester.last_reason.startswith('Unchanged'):
+      print 'Repeated PUT should leave the doctor unchanged, gave %r' % (
+          tester.last_reason)
+      sys.exit(1)
+    if tester.last_headers.get('x-unchanged-ids') != str(new_doctor_id):
+      print 'Repeated PUT should give X-Unchanged-Ids %r, gave %r' % (
+          str(new_doctor_id), tester.last_headers.get('x-unchanged-ids'))
+      sys.exit(1)
+    # a bulk PUT reports the entities it left unchanged just the same
+    self.emit('Check bulk PUT idempotence')
+    bulk_body = codecutil.dumps([dict(id=new_doctor_id, name=docname)])
+    tester.request_and_show('PUT', '/Doctor/', bulk_body)
+    if tester.last_headers.get('x-unchanged-ids') != str(new_doctor_id):
+      print 'Repeated bulk PUT should give X-Unchanged-Ids %r, gave %r' % (
+          str(new_doctor_id), tester.last_headers.get('x-unchanged-ids'))
+      sys.exit(1)
     # show new doctor just not-changed
     self.emit('New Doctor just not-changed:')
     new_doctor = tester.request_and_show('GET', new_doctor_path)
@@ -96,13 +120,66 @@ class TemplateTest(object):
           docname, new_doctor['name'])
       sys.exit(1)
     
+    # a minimal PUT response has just the id
+    self.emit('PUT with a minimal response:')
+    put_result = tester.request_and_show('PUT',
+        '%s?return=minimal' % new_doctor_path, put_body)
+    if put_result != dict(id=new_doctor_id):
+      print 'Minimal PUT should give %r, gave %r' % (dict(id=new_doctor_id),
+                                                   put_result)
+      sys.exit(1)
+
     self.emit('IDs of Doctors after second PUT:')
-    doctorids = tester.request_and_show('GET', '/Doctor/')
+    doctorids = tester.request_all_pages('/Doctor/')
     if len(doctorids) != num_doctors:
       print 'Had %d doctors, put %d again, should have %d but have %d' % (
           num_doctors, 1, num_doctors, len(doctorids))
       sys.exit(1)
     
+    # walking the Doctors in tiny pages must give the same IDs, in order
+    self.emit('IDs of Doctors, two per page:')
+    paged_doctorids = tester.request_all_pages('/Doctor/', limit=2)
+    if paged_doctorids != doctorids:
+      print 'Walking pages of 2 gave %r, should give %r' % (
+          paged_doctorids, doctorids)
+      sys.exit(1)
+
+    # create two more Doctors at once (with an invalid item in between)
+    self.emit('Bulk creation of Doctors:')
+    post_body = codecutil.dumps([dict(name='%s bis' % docname),
+                                  dict(nome='misspelled property'),
+                                  dict(name='%s ter' % docname)])
+    post_result = tester.request_and_show('POST', '/Doctor/', post_body)
+    if [sorted(obj) for obj in post_result] != [
+        ['id', 'name'], ['error'], ['id', 'name']]:
+      print 'Bulk POST should create 2 doctors and fail 1, gave %r' % (
+          post_result,)
+      sys.exit(1)
+    doctorids = tester.silent_request_all_pages('/Doctor/')
+    if len(doctorids) != num_doctors + 2:
+      print 'Had %d doctors, created %d, should have %d but have %d' % (
+          num_doctors, 2, num_doctors+2, len(doctorids))
+      sys.exit(1)
+    num_doctors = len(doctorids)
+
+    # filtering on the name must find just the (renamed) new doctor
+    self.emit('IDs of Doctors with name %r:' % docname)
+    named_doctorids = tester.request_all_pages(
+        '/Doctor/?%s' % urllib.urlencode(dict(name=docname)))
+    if named_doctorids != [dict(id=new_doctor_id)]:
+      print 'Filtering on name gave %r, should give %r' % (
+          named_doctorids, [dict(id=new_doctor_id)])
+      sys.exit(1)
+
+    # sorting on the name, descending, must give all doctors in that order
+    self.emit('Names of Doctors, sorted by name descending:')
+    sorted_doctors = tester.request_all_pages('/Doctor/?fields=name&order=-name')
+    names = [obj.get('name') for obj in sorted_doctors]
+    if len(names) != num_doctors or names != sorted(names, reverse=True):
+      print 'Sorting by -name gave %r, should give %d names in reverse order' % (
+          names, num_doctors)
+      sys.exit(1)
+
     # testing cookie functionality
     # each call to test_cookie should return an incremented value of
     # cookie named secret_key
@@ -0,0 +1,393 @@
+''' Caching helpers for gae-json-rest.
+
+This module offers a read-through cache of entities, keyed by model name and
+numeric ID, meant to sit in front of the datastore gets that jsonutil does,
+and a cache of the JSON texts of entities, keyed by entity version; writes
+done via jsonutil invalidate the cached entities (and bump the versions) they
+touch.
+
+The caches are pluggable: jsonutil uses whatever EntityCache and JsonCache
+instances are set as this module's entity_cache and json_cache (None, the
+default, means no caching at all).  Caches store values in a backend, like:
+  LruBackend: an in-process, size-bounded LRU dict (fastest, but per-process:
+    writes done by other processes won't invalidate it, so give it a TTL!)
+  MemcacheBackend: memcache (shared by all processes); with no client given
+    it uses GAE's memcache, or LocalMemcache (an in-process stand-in with
+    the same API) when that's unavailable
+  ChainBackend: several backends, tried in order (e.g. LRU then memcache)
+
+Entities are stored in their protobuf-encoded form, so that entities handed
+out by the cache are always fresh objects, which callers may modify freely.
+Caches are filled with add, never set, and invalidating an entity locks its
+key against adds for a few seconds (EntityCache.lock_seconds): so a reader
+that fetched an entity just before a write can't put the stale entity back
+in the cache after the writer invalidated it.  Still, cached entities are
+only for reads: writes must read-modify-write entities fresh from the
+datastore (as jsonutil does), since an LruBackend may be stale.
+Hit/miss counters are kept by each cache; function stats reports them.
+'''
+import hashlib
+import logging
+import random
+import time
+
+from google.appengine.ext import db
+
+import restutil
+
+# (LocalMemcache.set_multi's time argument hides the time module)
+_now = time.time
+
+
+class LocalMemcache(object):
+  """ In-process stand-in for GAE's memcache, with the same multi-key API.
+
+  Only supports what backends need: get_multi, set_multi, add_multi and
+  delete_multi (w/memcache's locking of deleted keys against adds).
+  """
+
+  def __init__(self):
+    self.data = dict()
+    self.locks = dict()
+
+  def get_multi(self, keys, key_prefix=''):
+    now = _now()
+    result = dict()
+    for key in keys:
+      item = self.data.get(key_prefix + key)
+      if item is not None:
+        value, expires = item
+        if expires and expires < now:
+          del self.data[key_prefix + key]
+        else:
+          result[key] = value
+    return result
+
+  def set_multi(self, mapping, time=0, key_prefix=''):
+    if time: expires = _now() + time
+    else: expires = 0
+    for key, value in mapping.iteritems():
+      self.locks.pop(key_prefix + key, None)
+      self.data[key_prefix + key] = value, expires
+    return []
+
+  def add_multi(self, mapping, time=0, key_prefix=''):
+    now = _now()
+    present = self.get_multi(mapping.keys(), key_prefix=key_prefix)
+    to_set = dict()
+    not_added = []
+    for key, value in mapping.iteritems():
+      if key in present or self.locks.get(key_prefix + key, 0) > now:
+        not_added.append(key)
+      else:
+        to_set[key] = value
+    self.set_multi(to_set, time=time, key_prefix=key_prefix)
+    return not_added
+
+  def delete_multi(self, keys, seconds=0, key_prefix=''):
+    for key in keys:
+      self.data.pop(key_prefix + key, None)
+      if seconds:
+        self.locks[key_prefix + key] = _now() + seconds
+    return True
+
+
+class LruBackend(object):
+  """ In-process cache, holding at most size values (dropping the least
+  recently used ones), each for at most ttl seconds (0 for no limit).
+  """
+
+  def __init__(self, size=1000, ttl=60):
+    self.size = size
+    self.ttl = ttl
+    self.data = dict()
+    self.tick = 0
+
+  def __len__(self):
+    return len(self.data)
+
+  def get_multi(self, keys):
+    now = _now()
+    result = dict()
+    for key in keys:
+      item = self.data.get(key)
+      if item is None: continue
+      if item[1] and item[1] < now:
+        del self.data[key]
+        continue
+      self.tick += 1
+      item[2] = self.tick
+      result[key] = item[0]
+    return result
+
+  def set_multi(self, mapping):
+    if self.ttl: expires = _now() + self.ttl
+    else: expires = 0
+    for key, value in mapping.iteritems():
+      self.tick += 1
+      self.data[key] = [value, expires, self.tick]
+    if len(self.data) > self.size:
+      self._trim()
+
+  def add_multi(self, mapping):
+    present = self.get_multi(mapping.keys())
+    self.set_multi(dict([(key, value) for key, value in mapping.iteritems()
+                         if key not in present]))
+    return present.keys()
+
+  def delete_multi(self, keys, seconds=0):
+    # (being per-process, an LRU need not lock keys against racing adds)
+    for key in keys:
+      self.data.pop(key, None)
+
+  def _trim(self):
+    """ Drop least recently used values to get down to 3/4 of size. """
+    by_age = sorted(self.data.iteritems(), key=lambda item: item[1][2])
+    for key, item in by_age[:len(self.data) - self.size * 3 // 4]:
+      del self.data[key]
+
+
+class MemcacheBackend(object):
+  """ Cache in memcache (or any object w/memcache's multi-key API), holding
+  each value for at most ttl seconds (0 for no limit).
+  """
+
+  def __init__(self, client=None, ttl=600, key_prefix='jsonrest:'):
+    if client is None:
+      try:
+        from google.appengine.api import memcache as client
+      except ImportError:
+        logging.warning('No memcache, using an in-process LocalMemcache')
+        client = LocalMemcache()
+    self.client = client
+    self.ttl = ttl
+    self.key_prefix = key_prefix
+
+  def get_multi(self, keys):
+    return self.client.get_multi(keys, key_prefix=self.key_prefix)
+
+  def set_multi(self, mapping):
+    self.client.set_multi(mapping, time=self.ttl, key_prefix=self.key_prefix)
+
+  def add_multi(self, mapping):
+    return self.client.add_multi(mapping, time=self.ttl,
+                                 key_prefix=self.key_prefix)
+
+  def delete_multi(self, keys, seconds=0):
+    self.client.delete_multi(keys, seconds=seconds,
+                             key_prefix=self.key_prefix)
+
+
+class ChainBackend(object):
+  """ Several backends, fastest first: gets try each in turn (and copy what
+  later ones have into earlier ones), sets and deletes go to all of them,
+  adds too, last (i.e. most shared) first: a key any of them refuses to add
+  isn't added to those before it.
+  """
+
+  def __init__(self, *backends):
+    self.backends = backends
+
+  def get_multi(self, keys):
+    result = dict()
+    missing = list(keys)
+    earlier = []
+    for backend in self.backends:
+      if not missing: break
+      found = backend.get_multi(missing)
+      if found:
+        for previous in earlier:
+          previous.set_multi(found)
+        result.update(found)
+        missing = [key for key in missing if key not in found]
+      earlier.append(backend)
+    return result
+
+  def set_multi(self, mapping):
+    for backend in self.backends:
+      backend.set_multi(mapping)
+
+  def add_multi(self, mapping):
+    mapping = dict(mapping)
+    not_added = []
+    for i in range(len(self.backends) - 1, -1, -1):
+      if not mapping: break
+      for key in self.backends[i].add_multi(mapping):
+        del mapping[key]
+        not_added.append(key)
+    return not_added
+
+  def delete_multi(self, keys, seconds=0):
+    for backend in self.backends:
+      backend.delete_multi(keys, seconds)
+
+
+def _encode_entity(entity):
+  return db.model_to_protobuf(entity).Encode()
+
+def _decode_entity(data):
+  return db.model_from_protobuf(data)
+
+
+def entity_key(model, numid):
+  """ Cache key for the entity of a model with a given numeric ID. """
+  return '%s/%d' % (restutil.nameFromModelClass(model) or model.kind(), numid)
+
+
+class _CountingCache(object):
+  """ Base for caches that keep hit and miss counters. """
+
+  def __init__(self, backend=None):
+    if backend is None:
+      backend = LruBackend()
+    self.backend = backend
+    self.hits = self.misses = 0
+
+  def stats(self):
+    """ Get a dict with the hit and miss counters (and the hit ratio). """
+    lookups = self.hits + self.misses
+    if lookups: ratio = float(self.hits) / lookups
+    else: ratio = 0.0
+    return dict(hits=self.hits, misses=self.misses, hit_ratio=ratio)
+
+
+class EntityCache(_CountingCache):
+  """ Read-through cache of entities, keyed by model name and numeric ID. """
+
+  key = staticmethod(entity_key)
+  # seconds for which invalidated keys can't be filled again (longer than
+  # any fetch that may have read an entity before it was invalidated)
+  lock_seconds = 10
+
+  def get_by_ids(self, model, ids, fetch):
+    """ Get entities of a model given IDs, fetching only the uncached ones.
+
+    Args:
+      model: a Model
+      ids: a list of ints
+      fetch: callable taking a list of ints, returning the list of entities
+        of model with those IDs (in the same order, None for missing ones)
+    Returns:
+      a list of entities, in the same order as ids (None for missing ones)
+    Side effects:
+      caches the fetched entities (unless they're cached meanwhile, or were
+      just invalidated)
+    """
+    keys = [self.key(model, numid) for numid in ids]
+    cached = self.backend.get_multi(keys)
+    entities = []
+    missing_ids = []
+    for key, numid in zip(keys, ids):
+      data = cached.get(key)
+      if data is None:
+        missing_ids.append(numid)
+        entities.append(None)
+      else:
+        entities.append(_decode_entity(data))
+    self.hits += len(ids) - len(missing_ids)
+    self.misses += len(missing_ids)
+    if missing_ids:
+      fetched = dict()
+      to_cache = dict()
+      for numid, entity in zip(missing_ids, fetch(missing_ids)):
+        if entity is not None:
+          fetched[numid] = entity
+          to_cache[self.key(model, numid)] = _encode_entity(entity)
+      if to_cache:
+        self.backend.add_multi(to_cache)
+      for i, numid in enumerate(ids):
+        if entities[i] is None:
+          entities[i] = fetched.get(numid)
+    return entities
+
+  def invalidate(self, model, ids):
+    """ Drop from the cache entities of a model given their IDs (and keep
+    them from being cached again for lock_seconds).
+    """
+    self.backend.delete_multi([self.key(model, numid) for numid in ids],
+                              self.lock_seconds)
+
+
+class JsonCache(_CountingCache):
+  """ Cache of entities' JSON texts, keyed by model name, numeric ID,
+  version stamp and variant.
+
+  An entity's version stamp is itself cached: bumping it (on any write of
+  the entity) just drops it, and a fresh random one is made when next
+  needed, so texts cached for older versions are never served again (and
+  simply expire from the backend).  The variant is a str identifying which
+  representation of the entity the text is (e.g. which fields it has), so
+  different representations of the same entity version don't collide.
+
+  Compressed forms of responses are cached too, keyed by their (strong)
+  ETags, so hot responses need not be compressed anew for each request.
+  """
+
+  @staticmethod
+  def _version_key(model, numid):
+    return 'v:' + entity_key(model, numid)
+
+  def version(self, model, numid, create=True):
+    """ Get the current version stamp (a str) of an entity (if it has none,
+    make one, or, if create is False, return None).
+    """
+    key = self._version_key(model, numid)
+    version = self.backend.get_multi([key]).get(key)
+    if version is None and create:
+      version = '%x%x' % (int(_now() * 1000), random.getrandbits(32))
+      self.backend.set_multi({key: version})
+    return version
+
+  def bump(self, model, ids):
+    """ Change the version stamps of entities of a model given their IDs. """
+    self.backend.delete_multi([self._version_key(model, numid)
+                               for numid in ids])
+
+  @staticmethod
+  def _key(model, numid, version, variant):
+    if len(variant) > 64:
+      variant = hashlib.md5(variant).hexdigest()
+    return 'j:%s@%s:%s' % (entity_key(model, numid), version, variant)
+
+  def get(self, model, numid, version, variant=''):
+    """ Get the cached JSON text for an entity version's variant, or None. """
+    key = self._key(model, numid, version, variant)
+    text = self.backend.get_multi([key]).get(key)
+    if text is None: self.misses += 1
+    else: self.hits += 1
+    return text
+
+  def set(self, model, numid, version, variant, text):
+    """ Cache the JSON text for an entity version's variant. """
+    self.backend.set_multi({self._key(model, numid, version, variant): text})
+
+  def get_compressed(self, etag, encoding):
+    """ Get the cached compressed form of a response given its ETag and
+    content-coding (e.g. 'gzip'), or None.
+    """
+    key = 'z:%s:%s' % (encoding, etag)
+    data = self.backend.get_multi([key]).get(key)
+    if data is None: self.misses += 1
+    else: self.hits += 1
+    return data
+
+  def set_compressed(self, etag, encoding, data):
+    """ Cache the compressed form of a response given its ETag and
+    content-coding (e.g. 'gzip').
+    """
+    self.backend.set_multi({'z:%s:%s' % (encoding, etag): data})
+
+
+# the EntityCache and JsonCache jsonutil uses (None for no caching)
+entity_cache = None
+json_cache = None
+
+
+def stats():
+  """ Get a dict with the counters of entity_cache and json_cache (if any). """
+  result = dict()
+  if entity_cache is not None:
+    result['entities'] = entity_cache.stats()
+  if json_cache is not None:
+    result['json'] = json_cache.stats()
+  return result
@@ -0,0 +1,133 @@
+''' Pluggable JSON codec for gae-json-rest.
+
+jsonutil (and testutil) encode and decode JSON via this module's dumps, dump
+and loads, which use whichever JSON library ("backend") was picked at import
+time: the first one of PREFERENCE that has C accelerations, or, if none has,
+the first one that's importable at all.  Backends are:
+  json: the standard library's json module (Python 2.6+; accelerated by the
+    _json extension in 2.7)
+  simplejson: the simplejson package (the one bundled with gae-json-rest, if
+    no other is installed; accelerated only with its _speedups extension)
+  django: django.utils.simplejson (what GAE's Python 2.5 runtime offers)
+
+All backends give the same text for the same jobjs (see test_codecutil.py),
+so which one runs is invisible to clients; use() switches backend explicitly
+(e.g. to compare them, as abench.py does).
+
+Encoding skips the backend's check for circular references: what's encoded
+here is data the server itself made (jobjs and lists of them), never cyclic.
+'''
+import logging
+
+# backend names, most preferred first (on equal acceleration)
+PREFERENCE = ('json', 'simplejson', 'django')
+
+
+def _import(name):
+  if name == 'json':
+    import json as module
+  elif name == 'simplejson':
+    import simplejson as module
+  elif name == 'django':
+    from django.utils import simplejson as module
+  else:
+    raise KeyError('Unknown JSON backend %r (known: %s)' % (name,
+                   ', '.join(PREFERENCE)))
+  return module
+
+
+def isAccelerated(module):
+  """ Does a json-like module have C implementations of its hot spots? """
+  decoder = getattr(module, 'decoder', None)
+  encoder = getattr(module, 'encoder', None)
+  return bool(getattr(decoder, 'c_scanstring', None) and
+              (getattr(encoder, 'c_make_encoder', None) or
+               getattr(encoder, 'c_encode_basestring_ascii', None)))
+
+
+def backends():
+  """ Get the importable backends.
+
+  Returns:
+    a list of (name, module, accelerated) triples, in PREFERENCE order
+  """
+  result = []
+  for name in PREFERENCE:
+    try:
+      module = _import(name)
+    except ImportError:
+      continue
+    result.append((name, module, isAccelerated(module)))
+  return result
+
+
+name = module = None
+_encoder = None
+# encode_string(s) encodes a str or unicode s into a JSON str just as
+# dumps(s) does, only faster (using the backend's string encoder)
+encode_string = None
+
+def use(backend_name=None):
+  """ Select the backend that dumps, dump and loads use.
+
+  Args:
+    backend_name: one of PREFERENCE, or None to pick the fastest available
+  Side effects:
+    sets this module's name, module and encode_string (and the encoder
+    dumps uses)
+  Raises:
+    ImportError if the backend (or, for None, any backend) is unavailable
+  """
+  global name, module, _encoder, encode_string
+  if backend_name is not None:
+    module = _import(backend_name)
+    name = backend_name
+  else:
+    module, name = _fastest()
+  _encoder = module.JSONEncoder(check_circular=False)
+  encode_string = getattr(getattr(module, 'encoder', None),
+                          'encode_basestring_ascii', None) or _encoder.encode
+
+
+def _fastest():
+  """ Get the (module, name) of the fastest available backend. """
+  available = backends()
+  if not available:
+    raise ImportError('No JSON backend available (tried: %s)' %
+                      ', '.join(PREFERENCE))
+  for backend in available:
+    if backend[2]:
+      break
+  else:
+    backend = available[0]
+  name, module, accelerated = backend
+  logging.info('JSON backend: %s (%saccelerated)', name,
+               ('not ', '')[accelerated])
+  return module, name
+
+use()
+
+
+def dumps(jdata):
+  """ Encode (acyclic) data into a JSON str. """
+  return _encoder.encode(jdata)
+
+
+def dump(jdata, fp):
+  """ Encode (acyclic) data into JSON, writing it on a file-like object.
+
+  The text is made in one go, as by dumps: backends' iterencode may not use
+  their C encoder (the json module's doesn't), which makes it much slower.
+  """
+  fp.write(dumps(jdata))
+
+
+def loads(text, object_hook=None):
+  """ Decode a JSON str, raising ValueError if it's not valid JSON.
+
+  object_hook, if given, is called with each JSON object decoded (as a
+  dict, innermost first), and what it returns replaces that object.
+  """
+  if object_hook is None:
+    return module.loads(text)
+  return module.loads(text, object_hook=object_hook)
@@ -31,7 +31,8 @@ import restutil
 class JsonRestHelper(object):
 
   prefix_to_ignore = '/'
-  __delete_parser = __put_parser = __post_parser = __get_parser = None
+  __delete_parser = __put_parser = __patch_parser = None
+  __post_parser = __get_parser = None
 
   def hookup(self, handler):
     """ "Hooks up" this helper instance to a handler object.
@@ -40,7 +41,7 @@ class JsonRestHelper(object):
       handler: an instance of a webapp.RequestHandler subclass
     Side effects:
       - sets self.handler to handler
-      - sets the handler's get, put, post and delete methods from self
+      - sets the handler's get, put, patch, post and delete methods from self
       - sets the handler's jrh attribute to self
     Note this creates reference loops and MUST be undone in hookdown!
     """
@@ -48,6 +49,7 @@ class JsonRestHelper(object):
     self.handler = handler
     handler.get = self.get
     handler.put = self.put
+    handler.patch = self.patch
     handler.post = self.post
     handler.delete = self.delete
     handler.jrh = self
@@ -57,13 +59,34 @@ class JsonRestHelper(object):
     logging.info('hookdn %r/%r', self, self.handler)
     h = self.handler
     h.jrh = self.handler = None
-    del h.get, h.put, h.post, h.delete
+    del h.get, h.put, h.patch, h.post, h.delete
 
   def _serve(self, data):
     """ Serves a result in JSON, and hooks-down from the handler """
-    try: return jsonutil.send_json(self.handler.response, data)
+    try: return jsonutil.send_json(self.handler.response, data,
+                                   self.handler.request)
     finally: self.hookdown()
 
+  def not_modified(self, etag):
+    """ Sets an ETag, and checks it against the request's If-None-Match.
+
+    Args:
+      etag: a quoted ETag for the (uncompressed) response being served
+    Returns:
+      True iff the client already has that response (so, needs no body)
+    Side effects:
+      sets the response's ETag header (made distinct for each content-coding
+      the response may be compressed with, see jsonutil.coded_etag); sets
+      status 304 if returning True
+    """
+    etag = jsonutil.coded_etag(etag,
+                               jsonutil.accepted_encoding(self.handler.request))
+    self.handler.response.headers['ETag'] = etag
+    if jsonutil.etag_matches(self.handler.request, etag):
+      self.handler.response.set_status(304)
+      return True
+    return False
+
   def get_model(self, modelname):
     """ Gets a model (or None) given a model name.
 
@@ -95,12 +118,14 @@ class JsonRestHelper(object):
                                              specialname)
     return special
 
-  def get_entity(self, modelname, strid):
+  def get_entity(self, modelname, strid, fresh=False):
     """ Gets an entity (or None) given a model name and entity ID as string.
 
     Args:
       modelname: a string that should name a model
       strid: the str(id) for the numeric id of an entity of that model
+      fresh: bool: if True, get it from the datastore, not the cache (as
+        must be done for entities that will be modified)
     Returns:
       an entity, or None (if something went wrong)
     Side effects:
@@ -109,7 +134,7 @@ class JsonRestHelper(object):
     model = self.get_model(modelname)
     if model is None:
       return None
-    entity = model.get_by_id(int(strid))
+    entity = jsonutil.get_entity(model, int(strid), fresh)
     if entity is None:
       self.handler.response.set_status(404, "Entity %s/%s not found" %
                                              (modelname, strid))
@@ -184,18 +209,29 @@ class JsonRestHelper(object):
   def do_delete(self, model, strid):
     """ Hook method to delete an entity given modelname and strid.
     """
-    entity = self.get_entity(model, strid)
+    entity = self.get_entity(model, strid, fresh=True)
     if entity is not None:
-      entity.delete()
+      jsonutil.delete_entity(entity)
+    return {}
+
+  def do_delete_entities(self, model, strids):
+    """ Hook method to delete many entities given modelname and strids.
+    """
+    themodel = self.get_model(model)
+    if themodel is None: return ''
+    ids = [int(strid) for strid in strids.split(',')]
+    jsonutil.delete_entities(themodel, ids)
     return {}
 
   def delete(self, prefix=None):
     """ Delete an entity given by path modelname/strid
+        (or many entities, given by path modelname/strid,strid,...)
         Response is JSON for an empty jobj.
     """
     if self.__delete_parser is None:
       self.__delete_parser = parsutil.RestUrlParser(self.prefix_to_ignore,
-          do_model_strid=self.do_delete)
+          do_model_strid=self.do_delete,
+          do_model_strids=self.do_delete_entities)
     path = self.handler.request.path
     result = self.__delete_parser.process(path, prefix)
     if result is None or isinstance(result, tuple):
@@ -205,23 +241,93 @@ class JsonRestHelper(object):
   def do_put(self, model, strid):
     """ Hook method to update an entity given modelname and strid.
     """
-    entity = self.get_entity(model, strid)
+    entity = self.get_entity(model, strid, fresh=True)
     if entity is None:
       return {}
-    jobj = jsonutil.receive_json(self.handler.request)
-    jobj = jsonutil.update_entity(entity, jobj)
-    updated_entity_path = "/%s/%s" % (model, jobj['id'])
-    self.handler.response.set_status(200, 'Updated entity %s' %
-                                           updated_entity_path)
+    check_refs = jsonutil.flag_param(self.handler.request, 'check_refs')
+    try:
+      jobj = jsonutil.receive_entity_dicts(self.handler.request,
+                                           type(entity))
+      changed = jsonutil.save_changes(entity, jobj, check_refs)
+    except jsonutil.BadRequestError, e:
+      self.handler.response.set_status(400, str(e))
+      return {}
+    minimal = self.return_param() == 'minimal'
+    if minimal:
+      jobj = jsonutil.id_of(entity)
+    else:
+      jobj = jsonutil.make_jobj(entity)
+    self._set_update_status(model, jobj['id'], changed, minimal)
     return jobj
 
+  def return_param(self):
+    """ Gets what the request prefers as response (see jsonutil.return_param).
+
+    Side effects:
+      for 'minimal' (the only value all write methods honor), sets the
+      response's Preference-Applied header
+    """
+    value = jsonutil.return_param(self.handler.request)
+    if value == 'minimal':
+      self.handler.response.headers['Preference-Applied'] = 'return=minimal'
+    return value
+
+  def _set_update_status(self, model, strid, changed, minimal=False):
+    """ Sets the 200 status (and message) for an update of an entity, and,
+    for a minimal response, the Location of the entity; if the update
+    changed nothing, says so in the response's X-Unchanged-Ids header too.
+    """
+    updated_entity_path = "/%s/%s" % (model, strid)
+    if minimal:
+      self.handler.response.headers['Location'] = updated_entity_path
+    if changed:
+      self.handler.response.set_status(200, 'Updated entity %s' %
+                                             updated_entity_path)
+    else:
+      jsonutil.set_unchanged(self.handler.response, [strid])
+      self.handler.response.set_status(200, 'Unchanged entity %s' %
+                                             updated_entity_path)
+
+  def do_put_model(self, model):
+    """ Hook method to update many entities given modelname.
+    """
+    themodel = self.get_model(model)
+    if themodel is None: return ''
+    try:
+      jobjs = jsonutil.receive_entity_dicts(self.handler.request, themodel)
+      if not isinstance(jobjs, list):
+        raise jsonutil.BadRequestError('Body must be a list of jobjs')
+      atomic = jsonutil.flag_param(self.handler.request, 'atomic')
+      check_refs = jsonutil.flag_param(self.handler.request, 'check_refs')
+      minimal = self.return_param() == 'minimal'
+      results, unchanged = jsonutil.update_entities(themodel, jobjs, atomic,
+                                                    check_refs, minimal)
+    except jsonutil.BadRequestError, e:
+      self.handler.response.set_status(400, str(e))
+      return ''
+    jsonutil.set_unchanged(self.handler.response, unchanged)
+    return results
+
   def put(self, prefix=None):
     """ Update an entity given by path modelname/strid
         Request body is JSON for the needed changes
         Response is JSON for the updated entity.
+        To update many entities at once, the path is modelname, the body a
+        list of jobjs with ids, and the response a list of updated entities'
+        jobjs, or {"error": ...} for invalid ones or missing entities (with
+        ?atomic=1, any such error fails them all).
+        With ?check_refs=1, entities referenced in the body must all exist.
+        Entities the body changes nothing in are not put, and their IDs are
+        listed (comma-separated) in the response's X-Unchanged-Ids header,
+        which is absent if all were changed; for a single entity, the status
+        message also says "Unchanged" rather than "Updated".
+        With ?return=minimal (or header Prefer: return=minimal), jobjs in
+        the response are id-only (and, for a single entity, its path is
+        also given as the Location header).
     """
     if self.__put_parser is None:
       self.__put_parser = parsutil.RestUrlParser(self.prefix_to_ignore,
+          do_model=self.do_put_model,
           do_model_strid=self.do_put)
     path = self.handler.request.path
     result = self.__put_parser.process(path, prefix)
@@ -241,13 +347,77 @@ class JsonRestHelper(object):
                                              special, method, e))
       return ''
 
+  def do_patch(self, model, strid):
+    """ Hook method to partially update an entity given modelname and strid.
+    """
+    entity = self.get_entity(model, strid, fresh=True)
+    if entity is None:
+      return {}
+    request = self.handler.request
+    check_refs = jsonutil.flag_param(request, 'check_refs')
+    try:
+      jobj = jsonutil.receive_entity_dicts(request, type(entity))
+      if not isinstance(jobj, dict):
+        raise jsonutil.BadRequestError('Body must be a jobj')
+      changed = jsonutil.save_changes(entity, jobj, check_refs)
+    except jsonutil.BadRequestError, e:
+      self.handler.response.set_status(400, str(e))
+      return {}
+    returning = self.return_param()
+    if returning == 'minimal':
+      jobj = jsonutil.id_of(entity)
+    elif returning == 'changed':
+      jobj = jsonutil.make_jobj(entity, frozenset(changed))
+    else:
+      jobj = jsonutil.make_jobj(entity)
+    self._set_update_status(model, jobj['id'], changed,
+                            returning == 'minimal')
+    return jobj
+
+  def patch(self, prefix=None):
+    """ Partially update an entity given by path modelname/strid
+        Request body is JSON for a jobj with just the properties to change
+        (others are left alone, and not even converted).
+        If that changes nothing, the entity isn't put, the status message
+        says "Unchanged" rather than "Updated", and the response's header
+        X-Unchanged-Ids is the entity's ID.
+        Response is JSON for the updated entity, or, with ?return=changed,
+        for just its id and the properties that actually changed, or, with
+        ?return=minimal (or header Prefer: return=minimal), for just its id
+        (also given as the Location header).
+        With ?check_refs=1, entities referenced in the body must all exist.
+        As webapp may not dispatch PATCH requests, a POST with header
+        X-HTTP-Method-Override: PATCH is handled as a PATCH.
+    """
+    if self.__patch_parser is None:
+      self.__patch_parser = parsutil.RestUrlParser(self.prefix_to_ignore,
+          do_model_strid=self.do_patch)
+    path = self.handler.request.path
+    result = self.__patch_parser.process(path, prefix)
+    if result is None or isinstance(result, tuple):
+      self.handler.response.set_status(400, 'Invalid URL for PATCH: %r' % path)
+      return self._serve({})
+    return self._serve(result)
+
   def do_post_model(self, model):
-    """ Hook method to "call a model" (to create an entity)
+    """ Hook method to "call a model" (to create an entity, or many)
     """
     themodel = self.get_model(model)
     if themodel is None: return ''
-    jobj = jsonutil.receive_json(self.handler.request)
-    jobj = jsonutil.make_entity(themodel, jobj)
+    check_refs = jsonutil.flag_param(self.handler.request, 'check_refs')
+    try:
+      jobj = jsonutil.receive_entity_dicts(self.handler.request, themodel,
+                                           creating=True)
+      minimal = self.return_param() == 'minimal'
+      if isinstance(jobj, list):
+        atomic = jsonutil.flag_param(self.handler.request, 'atomic')
+        jobj = jsonutil.make_entities(themodel, jobj, atomic, check_refs,
+                                      minimal)
+      else:
+        jobj = jsonutil.make_entity(themodel, jobj, check_refs, minimal)
+    except jsonutil.BadRequestError, e:
+      self.handler.response.set_status(400, str(e))
+      return ''
     self._classname = model
     return jobj
 
@@ -267,20 +437,34 @@ class JsonRestHelper(object):
     """
     themethod = self.get_instance_method(model, method)
     if themethod is None: return ''
-    entity = self.get_entity(model, strid)
+    # the method may well modify (and put) the entity
+    entity = self.get_entity(model, strid, fresh=True)
     if entity is None: return ''
     try: return themethod(entity)
     except Exception, e:
       self.handler.response.set_status(400, "Can't call %r/%r/%r: %s" % (
                                              model, strid, method, e))
       return ''
+    finally:
+      # (even a failing method may have put the entity before failing)
+      jsonutil.invalidate_entity(entity)
 
   def post(self, prefix=None):
     """ Create an entity ("call a model") or perform other non-R/O "call".
 
         Request body is JSON for the needed entity or other call "args".
         Response is JSON for the updated entity (or "call result").
+        To create many entities at once, the body is a list of jobjs and the
+        response a list of the created entities' jobjs, or {"error": ...}
+        for invalid ones (with ?atomic=1, any invalid one fails them all).
+        With ?return=minimal (or header Prefer: return=minimal), the jobj
+        (or jobjs) in the response are id-only.
+        With ?check_refs=1, entities referenced in the body must all exist.
+        With header X-HTTP-Method-Override: PATCH, this is a PATCH instead.
     """
+    override = self.handler.request.headers.get('X-HTTP-Method-Override', '')
+    if override.upper() == 'PATCH':
+      return self.patch(prefix)
     if self.__post_parser is None:
       self.__post_parser = parsutil.RestUrlParser(self.prefix_to_ignore,
           do_special_method=self.do_post_special_method,
@@ -317,19 +501,99 @@ class JsonRestHelper(object):
       return ''
 
   def do_get_model(self, model):
-    """ Hook method to R/O "call a model" ("get list of all its IDs"...?)
+    """ Hook method to R/O "call a model" ("get a page of its IDs"...?)
     """
     themodel = self.get_model(model)
     if themodel is None: return ''
-    return [jsonutil.id_of(x) for x in themodel.all()]
+    try:
+      jobjs = jsonutil.list_model(themodel, self.handler.request,
+                                  self.handler.response)
+    except jsonutil.BadRequestError, e:
+      self.handler.response.set_status(400, str(e))
+      return ''
+    return self._text_unless_not_modified(jobjs)
+
+  def _text_unless_not_modified(self, jdata):
+    """ JSON text for jdata, or an empty one if the client already has it.
+    """
+    text = jsonutil.encode_json(jdata)
+    if self.not_modified(jsonutil.etag_of_text(text)):
+      return jsonutil.JsonText()
+    return text
 
   def do_get_entity(self, model, strid):
     """ Hook method to get data about an entity given model name and strid
     """
-    entity = self.get_entity(model, strid)
-    if entity is None:
+    themodel = self.get_model(model)
+    if themodel is None:
+      return {}
+    try:
+      fields = jsonutil.fields_params(themodel, self.handler.request)
+      expand = jsonutil.expand_params(themodel, self.handler.request)
+    except jsonutil.BadRequestError, e:
+      self.handler.response.set_status(400, str(e))
       return {}
-    return jsonutil.make_jobj(entity)
+    if expand:
+      # embedded related jobjs may change w/o this entity's version changing
+      entity = self.get_entity(model, strid)
+      if entity is None:
+        return {}
+      jobj = jsonutil.make_jobjs(themodel, [entity], expand, fields)[0]
+      return self._text_unless_not_modified(jobj)
+    numid = int(strid)
+    # with a version stamp, a 304 needs neither the entity nor its JSON; a
+    # stamp is only kept for an existing entity, so don't make one here (a
+    # missing entity must get a 404, even for If-None-Match: *)
+    version = jsonutil.entity_version(themodel, numid, create=False)
+    if version is not None:
+      etag = jsonutil.etag_of_version(version, jsonutil.variant_of(fields))
+      if self.not_modified(etag):
+        return jsonutil.JsonText()
+    text = jsonutil.get_entity_json(themodel, numid, fields, version)
+    if text is None:
+      del self.handler.response.headers['ETag']
+      self.handler.response.set_status(404, "Entity %s/%s not found" %
+                                             (model, strid))
+      return {}
+    if version is None:
+      # the text's own stamp (made just now, if any), so that its ETag is
+      # the one all later GETs of this representation will have
+      if text.version is None:
+        etag = jsonutil.etag_of_text(text)
+      else:
+        etag = jsonutil.etag_of_version(text.version,
+                                        jsonutil.variant_of(fields))
+      if self.not_modified(etag):
+        return jsonutil.JsonText()
+    return text
+
+  def do_get_entities(self, model, strids):
+    """ Hook method to get data about many entities given model name & strids
+    """
+    themodel = self.get_model(model)
+    if themodel is None: return ''
+    ids = [int(strid) for strid in strids.split(',')]
+    if len(ids) > jsonutil.MAX_PAGE_SIZE:
+      self.handler.response.set_status(400, 'Cannot get more than %d '
+          'entities at once' % jsonutil.MAX_PAGE_SIZE)
+      return ''
+    try:
+      fields = jsonutil.fields_params(themodel, self.handler.request)
+      expand = jsonutil.expand_params(themodel, self.handler.request)
+    except jsonutil.BadRequestError, e:
+      self.handler.response.set_status(400, str(e))
+      return ''
+    entities = jsonutil.get_entities(themodel, ids)
+    if not expand:
+      return self._text_unless_not_modified(
+          jsonutil.encode_entities(entities, fields))
+    found = [entity for entity in entities if entity is not None]
+    found_jobjs = iter(jsonutil.make_jobjs(themodel, found, expand, fields))
+    jobjs = []
+    for entity in entities:
+      if entity is None: jobjs.append(None)
+      else: jobjs.append(found_jobjs.next())
+    return self._text_unless_not_modified(jobjs)
 
   def do_get_model_method(self, model, method):
     """ Hook method to R/O call a method on a model given s.
@@ -360,8 +624,18 @@ class JsonRestHelper(object):
 
     Depending on the request path, serve as JSON to the response object:
     - for a path of /classname/id, a jobj for that entity
+    - for a path of /classname/id,id,..., a list of jobjs for those entities
+      (in the same order, with null for each missing entity)
     - for a path of /classname, a list of id-only jobjs for that model
+      (a page of them, as per ?limit= and ?cursor=, w/Link to next page,
+      filtered as per any ?prop=value or ?prop__op=value, sorted as per
+      any ?order=prop,-prop..., see queryutil)
     - or, the results of the method being called (should be R/O!)
+    For entities and collections, ?fields=prop,... limits jobjs to the given
+    properties (and id), ?expand=rel,... embeds related entities' jobjs (for
+    a collection, either makes its jobjs complete ones, not id-only ones).
+    Entity and collection responses have an ETag; when the request's
+    If-None-Match matches it, the response is a 304 with an empty body.
     """
     logging.info('GET path=%r, prefix=%r', self.handler.request.path, prefix)
     if self.__get_parser is None:
@@ -369,6 +643,7 @@ class JsonRestHelper(object):
           do_special_method=self.do_get_special_method,
           do_model=self.do_get_model,
           do_model_strid=self.do_get_entity,
+          do_model_strids=self.do_get_entities,
           do_model_method=self.do_get_model_method,
           do_model_strid_method=self.do_get_entity_method,
           )
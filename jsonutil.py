@@ -12,10 +12,23 @@ format of the numeric value of an entity; each other key must be the name of
 a property of that entity's Model, and the corresponding value must be a string
 that can be deserialized into a value of that property's type.
 """
+import cgi
+import gzip
+import hashlib
 import re
+import StringIO
+import urllib
+import zlib
 
+import cacheutil
+import codecutil
+import queryutil
 import restutil
-from django.utils import simplejson
+from google.appengine.ext import db
+
+
+class BadRequestError(ValueError):
+  """ Data in a request can't be used; handlers answer this with a 400. """
 
 
 def id_of(entity):
@@ -29,6 +42,166 @@ def id_of(entity):
   return dict(id=restutil.id_of(entity))
 
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# max number of entities per batched datastore put, get or delete
+MAX_BATCH_SIZE = 500
+
+def page_params(request_obj):
+  """ Get the paging parameters (?limit= and ?cursor=) of a request.
+
+  Args:
+    request_obj: an HTTP request object
+  Returns:
+    a 2-item tuple (limit, cursor): limit is an int (DEFAULT_PAGE_SIZE if
+    not given), cursor an opaque str (None if not given)
+  Raises:
+    BadRequestError if limit is not an int between 1 and MAX_PAGE_SIZE
+  """
+  limit = request_obj.get('limit')
+  if limit:
+    try:
+      limit = int(limit)
+    except ValueError:
+      limit = 0
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+      raise BadRequestError('limit must be between 1 and %d' % MAX_PAGE_SIZE)
+  else:
+    limit = DEFAULT_PAGE_SIZE
+  cursor = request_obj.get('cursor') or None
+  return limit, cursor
+
+
+def flag_param(request_obj, name):
+  """ Is a boolean query parameter (e.g. ?atomic=1) set in a request?
+
+  Args:
+    request_obj: an HTTP request object
+    name: the parameter's name
+  Returns:
+    True iff the parameter's value is 1, true, yes or on (in any case)
+  """
+  return request_obj.get(name, '').lower() in ('1', 'true', 'yes', 'on')
+
+
+# response header listing the IDs of entities that a write changed nothing in
+UNCHANGED_HEADER = 'X-Unchanged-Ids'
+
+def set_unchanged(response_obj, ids):
+  """ Tell the client which entities a write left unchanged (and didn't put).
+
+  Args:
+    response_obj: an HTTP response object
+    ids: a list of the numeric IDs of the entities left unchanged
+  Side effects:
+    sets the response's UNCHANGED_HEADER to the comma-separated IDs, if any
+  """
+  if ids:
+    response_obj.headers[UNCHANGED_HEADER] = ','.join([str(numid)
+                                                       for numid in ids])
+
+
+def return_param(request_obj):
+  """ What does a write request prefer to get back, as its response?
+
+  Args:
+    request_obj: an HTTP request object
+  Returns:
+    the value of ?return= if given, else that of return= in a Prefer
+    header (e.g. 'minimal' for Prefer: return=minimal), else None
+  """
+  value = request_obj.get('return')
+  if value: return value
+  for preference in request_obj.headers.get('Prefer', '').split(','):
+    name, sep, value = preference.strip().partition('=')
+    if name.strip().lower() == 'return' and value:
+      return value.strip().strip('"')
+  return None
+
+
+def fetch_page(query, limit=DEFAULT_PAGE_SIZE, cursor=None):
+  """ Fetch a page of results of a query, starting from a cursor.
+
+  Args:
+    query: a db.Query
+    limit: max number of results to fetch
+    cursor: an opaque str from a previous fetch_page, or None to start
+  Returns:
+    a 2-item tuple (results, next_cursor): next_cursor is None if there
+    are no more results
+  Raises:
+    BadRequestError if the cursor is invalid (or not for this query)
+  """
+  try:
+    if cursor:
+      query.with_cursor(cursor)
+    results = query.fetch(limit)
+  except (db.BadValueError, db.BadRequestError), e:
+    raise BadRequestError('Invalid cursor %r: %s' % (cursor, e))
+  if len(results) < limit:
+    return results, None
+  return results, query.cursor()
+
+
+def set_next_link(request_obj, response_obj, cursor):
+  """ Set a Link header to the next page of a collection, if any.
+
+  The link is to the request's own path and query, with ?cursor= set.
+
+  Args:
+    request_obj: an HTTP request object
+    response_obj: an HTTP response object
+    cursor: next_cursor from fetch_page (None if there's no next page)
+  """
+  if cursor is None: return
+  params = [(k, v) for k, v in cgi.parse_qsl(request_obj.query_string)
+            if k != 'cursor']
+  params.append(('cursor', cursor))
+  response_obj.headers['Link'] = '<%s?%s>; rel="next"' % (
+      request_obj.path, urllib.urlencode(params))
+
+
+def list_model(model, request_obj, response_obj):
+  """ Make a page of id-only jobjs for a model as a request asks.
+
+  With ?fields= and/or ?expand=, the jobjs have the given properties (all,
+  if only ?expand= is given), and related jobjs embedded (see make_jobjs).
+  Other query parameters are filters on properties (see queryutil), e.g.
+  ?name=Dr.%20Who or ?number__ge=555.
+
+  Args:
+    model: a Model
+    request_obj: an HTTP request object (w/optional ?limit= and ?cursor=,
+      optional ?fields= and ?expand=, and optional filters)
+    response_obj: an HTTP response object
+  Returns:
+    a list of {'id': <string-of-digits>} dicts (or complete jobjs): with
+    ?expand=, as a list, else, directly encoded, as a JsonText
+  Side effects:
+    sets a Link header to the next page on response_obj, if there's one
+  Raises:
+    BadRequestError if the request's parameters are invalid
+  """
+  limit, cursor = page_params(request_obj)
+  fields = fields_params(model, request_obj)
+  expand = expand_params(model, request_obj)
+  full = fields is not None or bool(expand)
+  try:
+    query = queryutil.make_query(model,
+        cgi.parse_qsl(request_obj.query_string), keys_only=not full)
+  except queryutil.BadQueryError, e:
+    raise BadRequestError(str(e))
+  results, next_cursor = fetch_page(query, limit, cursor)
+  if expand:
+    jobjs = make_jobjs(model, results, expand, fields)
+  elif full:
+    jobjs = encode_entities(results, fields)
+  else:
+    jobjs = encode_ids(results)
+  set_next_link(request_obj, response_obj, next_cursor)
+  return jobjs
+
+
 # RE to match: optional /, classname, optional /, ID of 0+ numeric digits
 CLASSNAME_ID_RE = re.compile(r'^/?(\w+)/?(\d*)$')
 
@@ -48,101 +221,1028 @@ def path_to_classname_and_id(path):
   else: return (None, '')
 
 
-def send_json(response_obj, jdata):
+class JsonText(str):
+  """ JSON text, already encoded: send_json sends it just as it is.
+
+  For an entity's text from get_entity_json, attribute version is the
+  entity version stamp the text is for (None if there's no JSON cache).
+  """
+  version = None
+
+
+def encode_json(jdata):
+  """ Encode data into JSON text.
+
+  Args:
+    jdata: a dict or list in correct 'JSONable' form
+  Returns:
+    a JsonText with the JSON form of jdata (jdata itself, if a JsonText)
+  """
+  if isinstance(jdata, JsonText):
+    return jdata
+  return JsonText(codecutil.dumps(jdata))
+
+
+class CompressedJson(str):
+  """ JSON text, already encoded and compressed with the content-coding
+  given as attribute encoding: send_json sends it just as it is.
+  """
+
+  def __new__(cls, data, encoding):
+    self = str.__new__(cls, data)
+    self.encoding = encoding
+    return self
+
+
+# content-codings send_json can compress with, most preferred first
+ENCODINGS = ('gzip', 'deflate')
+# JSON texts shorter than this are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+
+def accepted_encoding(request_obj):
+  """ Pick the content-coding to compress a response with.
+
+  Args:
+    request_obj: an HTTP request object
+  Returns:
+    the one of ENCODINGS that the request's Accept-Encoding header accepts
+    with the highest q-value (the earliest in ENCODINGS, on ties), or None
+  """
+  qualities = dict()
+  for item in request_obj.headers.get('Accept-Encoding', '').split(','):
+    coding, sep, params = item.partition(';')
+    quality = 1.0
+    for param in params.split(';'):
+      name, sep, value = param.partition('=')
+      if name.strip().lower() == 'q':
+        try:
+          quality = float(value)
+        except ValueError:
+          quality = 0.0
+    qualities[coding.strip().lower()] = quality
+  best = None
+  for encoding in ENCODINGS:
+    quality = qualities.get(encoding, qualities.get('*', 0.0))
+    if quality > 0 and (best is None or quality > best[0]):
+      best = quality, encoding
+  return best and best[1]
+
+
+def compress_json(text, encoding, etag=None):
+  """ Compress a JSON text, unless it's too short to be worth it.
+
+  Args:
+    text: a str, typically a JsonText
+    encoding: one of ENCODINGS
+    etag: the response's strong ETag (for this encoding), if any: then, the
+      compressed form is looked up in, and stored into, cacheutil.json_cache
+      (if set)
+  Returns:
+    text itself if shorter than COMPRESS_MIN_SIZE, else a CompressedJson
+  """
+  if len(text) < COMPRESS_MIN_SIZE:
+    return text
+  cache = cacheutil.json_cache
+  if etag and cache is not None:
+    data = cache.get_compressed(etag, encoding)
+    if data is not None:
+      return CompressedJson(data, encoding)
+  if encoding == 'gzip':
+    buf = StringIO.StringIO()
+    gz = gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=COMPRESS_LEVEL)
+    gz.write(text)
+    gz.close()
+    data = buf.getvalue()
+  else:
+    data = zlib.compress(text, COMPRESS_LEVEL)
+  if etag and cache is not None:
+    cache.set_compressed(etag, encoding, data)
+  return CompressedJson(data, encoding)
+
+
+def send_json(response_obj, jdata, request_obj=None):
   """ Send data in JSON form to an HTTP-response object.
 
   Args:
     response_obj: an HTTP response object
-    jdata: a dict or list in correct 'JSONable' form
+    jdata: a dict or list in correct 'JSONable' form, or a JsonText, or a
+      CompressedJson
+    request_obj: the HTTP request object being answered, if the response
+      may be compressed as its Accept-Encoding header allows
   Side effects:
-    sends the JSON form of jdata on response.out
+    sends the JSON form of jdata on response.out, compressed (with a
+    Content-Encoding header) if request_obj accepts that and it's long
+    enough; the response's ETag, if any (which must come from coded_etag,
+    with the content-coding request_obj accepts), keys the cached
+    compressed form; sets Vary: Accept-Encoding if request_obj is given
   """
   response_obj.content_type = 'application/json'
-  simplejson.dump(jdata, response_obj.out)
+  if request_obj is not None:
+    response_obj.headers['Vary'] = 'Accept-Encoding'
+    encoding = accepted_encoding(request_obj)
+    if encoding is not None and not isinstance(jdata, CompressedJson):
+      if not isinstance(jdata, JsonText):
+        jdata = encode_json(jdata)
+      jdata = compress_json(jdata, encoding,
+                            response_obj.headers.get('ETag'))
+  if isinstance(jdata, CompressedJson):
+    response_obj.headers['Content-Encoding'] = jdata.encoding
+    response_obj.out.write(jdata)
+  elif isinstance(jdata, JsonText):
+    response_obj.out.write(jdata)
+  else:
+    codecutil.dump(jdata, response_obj.out)
 
 
 def receive_json(request_obj):
   """ Receive data in JSON form from an HTTP-request object.
 
+  Just decodes the body: bodies with jobjs for a model are best received
+  with receive_entity_dicts, which also parses them as it decodes.
+
   Args:
     request_obj: an HTTP request object (with body in JSONed form)
   Returns:
     the JSONable-form result of loading the request's body
+  Raises:
+    BadRequestError if the body is not valid JSON
+  """
+  try:
+    return codecutil.loads(request_obj.body)
+  except ValueError, e:
+    raise BadRequestError('Invalid JSON body: %s' % e)
+
+
+def _fetch_entities(model, ids):
+  """ Get entities of a model given their numeric IDs, w/batched gets. """
+  if len(ids) <= MAX_BATCH_SIZE:
+    return model.get_by_id(ids)
+  entities = []
+  for i in range(0, len(ids), MAX_BATCH_SIZE):
+    entities.extend(model.get_by_id(ids[i:i+MAX_BATCH_SIZE]))
+  return entities
+
+
+def get_entities(model, ids, fresh=False):
+  """ Get entities of a model given their numeric IDs, w/batched gets.
+
+  Reads through cacheutil.entity_cache (if set), so only the entities that
+  are not cached get fetched from the datastore -- unless fresh is set, as
+  it must be to read entities that are then modified and put: cached ones
+  may be stale, and writing them back would lose others' updates.
+
+  Args:
+    model: a Model
+    ids: a list of ints
+    fresh: bool: if True, get all entities from the datastore (bypassing,
+      and not filling, the cache)
+  Returns:
+    a list of entities, in the same order as ids (None for missing ones)
+  """
+  cache = cacheutil.entity_cache
+  if cache is None or fresh:
+    return _fetch_entities(model, ids)
+  def fetch(ids): return _fetch_entities(model, ids)
+  return cache.get_by_ids(model, ids, fetch)
+
+
+def get_entity(model, numid, fresh=False):
+  """ Get the entity of a model given its numeric ID, or None (as above).
+
+  Args:
+    model: a Model
+    numid: an int
+    fresh: bool: if True, get it from the datastore, not the cache
+  Returns:
+    an entity, or None if there's no entity of model with that ID
+  """
+  return get_entities(model, [numid], fresh)[0]
+
+
+def entity_version(model, numid, create=True):
+  """ Get the version stamp of an entity from cacheutil.json_cache, if set.
+
+  Stamps are only kept for entities that exist (get_entity_json drops any
+  it made for a missing entity, writes drop them on deletes), so an entity
+  with a stamp exists, unless deleted other than via this module.
+
+  Args:
+    model: a Model
+    numid: an int
+    create: bool: if False, don't make a stamp for an entity having none
+  Returns:
+    a str (changing whenever the entity is written), or None if not caching
+    (or if the entity has no stamp yet, and create is False)
+  """
+  cache = cacheutil.json_cache
+  if cache is None:
+    return None
+  return cache.version(model, numid, create)
+
+
+def variant_of(fields=None):
+  """ Make a str identifying an entity representation given its options.
+
+  Args:
+    fields: as for make_jobj
+  Returns:
+    a str, '' for the plain jobj
+  """
+  if fields is None:
+    return ''
+  return 'fields=' + ','.join(sorted(fields))
+
+
+def etag_of_version(version, variant=''):
+  """ Make a strong ETag for an entity's representation given its version.
+
+  Args:
+    version: an entity version stamp, as from entity_version
+    variant: a str identifying the representation, as from variant_of
+  Returns:
+    a str, a quoted ETag
+  """
+  if variant:
+    return '"%s-%s"' % (version, hashlib.md5(variant).hexdigest()[:12])
+  return '"%s"' % version
+
+
+def etag_of_text(text):
+  """ Make a strong ETag for a JSON text, from a hash of its contents.
+
+  Args:
+    text: a str, typically a JsonText
+  Returns:
+    a str, a quoted ETag
+  """
+  return '"%s"' % hashlib.md5(text).hexdigest()
+
+
+def coded_etag(etag, encoding):
+  """ Make the strong ETag of a response sent with a content-coding.
+
+  A strong ETag must differ whenever the bytes sent do, so responses sent
+  compressed can't have the ETag of their uncompressed form.  The ETag
+  depends on the content-coding the request negotiates (as from
+  accepted_encoding), even if the response ends up too short to compress:
+  that way, it's known before the response's text is.
+
+  Args:
+    etag: a quoted ETag, as from etag_of_version or etag_of_text
+    encoding: one of ENCODINGS, or None for no content-coding
+  Returns:
+    a str, a quoted ETag (etag itself, if encoding is None)
+  """
+  if encoding is None:
+    return etag
+  return '%s-%s"' % (etag[:-1], encoding)
+
+
+def etag_matches(request_obj, etag):
+  """ Does a request's If-None-Match header match an ETag?
+
+  Args:
+    request_obj: an HTTP request object
+    etag: a quoted ETag
+  Returns:
+    True iff If-None-Match is * or lists etag (weakly or not)
+  """
+  header = request_obj.headers.get('If-None-Match')
+  if not header:
+    return False
+  for tag in header.split(','):
+    tag = tag.strip()
+    if tag == '*' or tag == etag or tag == 'W/' + etag:
+      return True
+  return False
+
+
+def get_entity_json(model, numid, fields=None, version=None):
+  """ Get the JSON text of the jobj of an entity given model and numeric ID.
+
+  Uses the text cached in cacheutil.json_cache (if set) for the entity's
+  current version, if any, so that the entity need not even be fetched;
+  otherwise, gets the entity, makes its jobj and encodes it (caching the
+  resulting text).  Text to cache is made from the entity as read from the
+  datastore, never from cacheutil.entity_cache: an LRU there may hold an
+  entity written since by another process, and text cached under a shared
+  version would spread that stale entity to all processes.
+
+  Args:
+    model: a Model
+    numid: an int
+    fields: as for make_jobj
+    version: the entity's version stamp, if the caller already has it from
+      entity_version (None to look it up if needed)
+  Returns:
+    a JsonText (with the version stamp it's for as attribute version, when
+    caching), or None if there's no entity of model with that ID
   """
-  return simplejson.loads(request_obj.body)
+  cache = cacheutil.json_cache
+  if cache is not None:
+    if version is None:
+      version = cache.version(model, numid)
+    variant = variant_of(fields)
+    text = cache.get(model, numid, version, variant)
+    if text is not None:
+      text = JsonText(text)
+      text.version = version
+      return text
+  entity = get_entity(model, numid, fresh=cache is not None)
+  if entity is None:
+    if cache is not None:
+      # keep no stamp for a missing entity (see entity_version)
+      cache.bump(model, [numid])
+    return None
+  text = encode_entity(entity, fields)
+  if cache is not None:
+    cache.set(model, numid, version, variant, str(text))
+    text.version = version
+  return text
 
 
-def make_jobj(entity):
+def _invalidate(model, ids):
+  """ Drop cached data about entities of a model given their numeric IDs.
+
+  Entities just created need no such call, as nothing about them can be
+  cached yet.
+  """
+  cache = cacheutil.entity_cache
+  if cache is not None:
+    cache.invalidate(model, ids)
+  cache = cacheutil.json_cache
+  if cache is not None:
+    cache.bump(model, ids)
+
+
+def invalidate_entity(entity):
+  """ Drop cached data about an entity written other than via this module
+  (e.g. by a model's instance method), so GETs don't serve its old state.
+
+  Args:
+    entity: an entity
+  Side effects:
+    drops the entity from the caches, and changes its version stamp
+  """
+  _invalidate(type(entity), [restutil.id_of(entity)])
+
+
+def make_jobj(entity, fields=None):
   """ Make a JSONable dict (a jobj) given an entity.
 
   Args:
     entity: an entity
+    fields: None for all properties, else a set of the names of the only
+      properties to convert and put in the jobj (besides the id)
   Returns:
     the JSONable-form dict (jobj) for the entity
   """
-  model = type(entity)
   jobj = id_of(entity)
-  props = restutil.allProperties(model)
-  for property_name, property_value in props:
-    value_in_entity = getattr(entity, property_name, None)
+  getters = restutil.propertyGetters(type(entity))
+  if fields is not None:
+    getters = [getter for getter in getters if getter[0] in fields]
+  for property_name, to_string, raw_property in getters:
+    if raw_property is None:
+      value_in_entity = getattr(entity, property_name, None)
+    else:
+      value_in_entity = raw_property.get_value_for_datastore(entity)
     if value_in_entity is not None:
-      to_string = getattr(model, property_name + '_to_string')
       jobj[property_name] = to_string(value_in_entity)
   return jobj
 
 
-def parse_jobj(model, jobj):
+def _encode_id(numid):
+  if isinstance(numid, (int, long)):
+    return '{"id": %d' % numid
+  return '{"id": ' + codecutil.dumps(numid)
+
+
+def encode_entity(entity, fields=None):
+  """ Encode the jobj of an entity into JSON text, directly.
+
+  Writes the text straight from the entity's attributes, following its
+  model's encoding plan (see restutil.propertyEncoders), so no jobj dict
+  is made.
+
+  Args:
+    entity: an entity
+    fields: as for make_jobj
+  Returns:
+    a JsonText, which decodes to what make_jobj(entity, fields) returns
+  """
+  encode_string = codecutil.encode_string
+  chunks = [_encode_id(restutil.id_of(entity))]
+  for name, fragment, to_string, raw_property in restutil.propertyEncoders(
+      type(entity)):
+    if fields is not None and name not in fields: continue
+    if raw_property is None:
+      value = getattr(entity, name, None)
+    else:
+      value = raw_property.get_value_for_datastore(entity)
+    if value is None: continue
+    value = to_string(value)
+    chunks.append(fragment)
+    if isinstance(value, basestring):
+      chunks.append(encode_string(value))
+    else:
+      chunks.append(codecutil.dumps(value))
+  chunks.append('}')
+  return JsonText(''.join(chunks))
+
+
+def encode_entities(entities, fields=None):
+  """ Encode a list of jobjs of entities into JSON text, directly.
+
+  Args:
+    entities: a list of entities (or Nones)
+    fields: as for make_jobj
+  Returns:
+    a JsonText, which decodes to the list of the entities' jobjs (as from
+    make_jobj), with null for each None
+  """
+  texts = []
+  for entity in entities:
+    if entity is None: texts.append('null')
+    else: texts.append(encode_entity(entity, fields))
+  return JsonText('[%s]' % ', '.join(texts))
+
+
+def encode_ids(keys):
+  """ Encode a list of id-only jobjs given entities' keys into JSON text. """
+  return JsonText('[%s]' % ', '.join([_encode_id(key.id()) + '}'
+                                       for key in keys]))
+
+
+def fields_params(model, request_obj):
+  """ Get the fields to return (?fields=a,b) of a request about a model.
+
+  Args:
+    model: a Model
+    request_obj: an HTTP request object
+  Returns:
+    a frozenset of names of model's properties, or None if ?fields= is not
+    given ('id' is always returned, so it may or may not be listed)
+  Raises:
+    BadRequestError if any name is not that of a property
+  """
+  names = request_obj.get('fields')
+  if not names:
+    return None
+  setters = restutil.propertySetters(model)
+  fields = set()
+  for name in names.split(','):
+    if not name or name == 'id': continue
+    try:
+      fields.add(setters[name][0])
+    except KeyError:
+      raise BadRequestError('Unknown property %r for model %s' % (
+          name, restutil.nameFromModelClass(model)))
+  return frozenset(fields)
+
+
+def expand_params(model, request_obj):
+  """ Get the relations to expand (?expand=a,b) of a request about a model.
+
+  Args:
+    model: a Model
+    request_obj: an HTTP request object
+  Returns:
+    a list of names of model's reference or reverse-reference properties
+    (empty if ?expand= is not given)
+  Raises:
+    BadRequestError if any name is not that of such a property
+  """
+  names = [name for name in request_obj.get('expand', '').split(',') if name]
+  if names:
+    forward = restutil.referenceProperties(model)
+    reverse = restutil.reverseReferences(model)
+    for name in names:
+      if name not in forward and name not in reverse:
+        raise BadRequestError('No relation %r to expand for model %s' % (
+            name, restutil.nameFromModelClass(model)))
+  return names
+
+
+def _expand_forward(prop, entities, jobjs):
+  """ Embed the jobjs entities refer to by prop, w/a batched get per kind. """
+  keys = [prop.get_value_for_datastore(entity) for entity in entities]
+  ids_by_kind = dict()
+  for key in keys:
+    if key is not None:
+      ids_by_kind.setdefault(key.kind(), set()).add(key.id())
+  related = dict()
+  for kind, ids in ids_by_kind.iteritems():
+    ids = list(ids)
+    for numid, entity in zip(ids, get_entities(db.class_for_kind(kind), ids)):
+      if entity is not None:
+        related[kind, numid] = make_jobj(entity)
+  for key, jobj in zip(keys, jobjs):
+    if key is not None:
+      jobj[prop.name] = related.get((key.kind(), key.id()))
+
+
+# max number of keys a reverse-reference expansion's range query may scan
+MAX_EXPAND_SCAN = 1000
+
+def _referring_keys(model, property_name, keys):
+  """ Get the keys of entities of model referring by property_name to any
+  of keys (and, maybe, of some referring to other keys too).
+
+  Tries a single keys-only range query, on the keys from the lowest to the
+  highest of keys (an IN filter would be run as one query per key).  That's
+  only tight if keys are about contiguous in key order: if the range holds
+  more than MAX_EXPAND_SCAN keys, rather than scanning it all, falls back to
+  one keys-only query per key.
+  """
+  ordered = sorted(keys)
+  if len(ordered) > 1:
+    query = model.all(keys_only=True)
+    query.filter('%s >=' % property_name, ordered[0])
+    query.filter('%s <=' % property_name, ordered[-1])
+    found = query.fetch(MAX_EXPAND_SCAN + 1)
+    if len(found) <= MAX_EXPAND_SCAN:
+      return found
+  found = []
+  for key in ordered:
+    found.extend(model.all(keys_only=True).filter('%s =' % property_name,
+                                                  key))
+  return found
+
+
+def _expand_reverse(name, model, property_name, entities, jobjs):
+  """ Embed lists of jobjs of entities of model referring to entities by
+  property_name, with (most often) a single keys-only query and batched
+  gets; entities found referring to others than these are dropped when
+  grouping related entities by the key they refer to.
+  """
+  prop = restutil.referenceProperties(model)[property_name]
+  keys = [entity.key() for entity in entities]
+  wanted = frozenset(keys)
+  related = dict()
+  referring = _referring_keys(model, property_name, keys)
+  for entity in get_entities(model, [key.id() for key in referring]):
+    if entity is None: continue
+    key = prop.get_value_for_datastore(entity)
+    if key in wanted:
+      related.setdefault(key, []).append(make_jobj(entity))
+  for key, jobj in zip(keys, jobjs):
+    jobj[name] = related.get(key, [])
+
+
+def make_jobjs(model, entities, expand=(), fields=None):
+  """ Make jobjs given entities of a model, embedding related jobjs.
+
+  Related entities are fetched for all entities at once: one batched get
+  per kind for each reference property, one keys-only query and batched
+  gets for each reverse-reference property (unless the entities' keys are
+  too spread out, see _referring_keys).
+
+  Args:
+    model: a Model
+    entities: a list of entities of that model
+    expand: names of reference properties, each replaced in jobjs by the
+      jobj of the entity it refers to (or null), and/or reverse-reference
+      properties, each added to jobjs as a list of the jobjs referring to it
+    fields: as for make_jobj (embedded jobjs are always complete)
+  Returns:
+    a list of jobjs, in the same order as entities
+  """
+  jobjs = [make_jobj(entity, fields) for entity in entities]
+  if expand and entities:
+    forward = restutil.referenceProperties(model)
+    reverse = restutil.reverseReferences(model)
+    for name in expand:
+      if name in forward:
+        _expand_forward(forward[name], entities, jobjs)
+      else:
+        other_model, property_name = reverse[name]
+        _expand_reverse(name, other_model, property_name, entities, jobjs)
+  return jobjs
+
+
+class EntityDict(dict):
+  """ Keyword arguments for a model, parsed from a jobj by parse_jobj; the
+  jobj's 'id' (None if it had none) is attribute id.
+  """
+  id = None
+
+
+def parse_jobj(model, jobj, creating=False):
   """ Make dict suitable for instantiating model, given a jobj.
 
+  Keys are looked up in the model's parsing plan (the jobj's 'id', if
+  present, is kept apart); null values are skipped, just like values that
+  their property's _from_string method turns into None.
+
   Args:
     model: a Model
     jobj: a jobj
+    creating: bool: if True, all required properties must be given (unless
+      they have a default)
   Returns:
-    a dict d such that calling model(**d) properly makes an entity
+    an EntityDict d such that calling model(**d) properly makes an entity
+  Raises:
+    BadRequestError for unknown properties, unparseable values, or (when
+    creating) missing required properties
   """
-  result = dict()
+  setters = restutil.propertySetters(model)
+  result = EntityDict()
   for property_name, property_value in jobj.iteritems():
-    # ensure we have an ASCII string, not a Unicode one
-    property_name = str(property_name)
-    from_string = getattr(model, property_name + '_from_string')
-    property_value = from_string(property_value)
+    try:
+      property_name, from_string, required = setters[property_name]
+    except KeyError:
+      if property_name == 'id':
+        result.id = property_value
+        continue
+      raise BadRequestError('Unknown property %r for model %s' % (
+          property_name, restutil.nameFromModelClass(model)))
+    if property_value is None: continue
+    try:
+      property_value = from_string(property_value)
+    except Exception, e:
+      raise BadRequestError('Bad value %r for property %r: %s' % (
+          property_value, property_name, e))
     if property_value is not None:
       result[property_name] = property_value
+  if creating:
+    for property_name, from_string, required in setters.itervalues():
+      if required and property_name not in result:
+        raise BadRequestError('Missing required property %r for model %s' % (
+            property_name, restutil.nameFromModelClass(model)))
   return result
 
 
-def make_entity(model, jobj):
+def _parse(model, jobj, creating=False):
+  """ parse_jobj, first checking that jobj is a dict at all (EntityDicts,
+  already parsed by receive_entity_dicts, and errors it met, pass through).
+  """
+  if isinstance(jobj, EntityDict):
+    return jobj
+  if isinstance(jobj, BadRequestError):
+    raise jobj
+  if not isinstance(jobj, dict):
+    raise BadRequestError('A jobj must be a JSON object, not %r' % (jobj,))
+  return parse_jobj(model, jobj, creating)
+
+
+def _jobj_parser(model, creating):
+  """ Make a decoder object_hook that parses each decoded jobj for model. """
+  def parse(jobj):
+    for value in jobj.itervalues():
+      if isinstance(value, (EntityDict, BadRequestError)):
+        return BadRequestError('Property values cannot be JSON objects')
+    try:
+      return parse_jobj(model, jobj, creating)
+    except BadRequestError, e:
+      return e
+  return parse
+
+
+def receive_entity_dicts(request_obj, model, creating=False):
+  """ Receive jobjs for a model from an HTTP-request object, parsing each
+  into model keyword arguments (as parse_jobj does) as soon as the decoder
+  has it, in the same pass that decodes the body.
+
+  Args:
+    request_obj: an HTTP request object (with body in JSONed form)
+    model: a Model
+    creating: bool: if True, all required properties must be given (unless
+      they have a default)
+  Returns:
+    for a body that's a jobj, an EntityDict; for a list of jobjs, a list
+    with, for each jobj in order, an EntityDict or, for an invalid one, a
+    BadRequestError (make_entities, update_entities, make_entity,
+    update_entity and save_changes all accept these in place of jobjs)
+  Raises:
+    BadRequestError if the body is not valid JSON, is an invalid jobj, or
+    is neither a jobj nor a list
+  """
+  try:
+    result = codecutil.loads(request_obj.body,
+                             object_hook=_jobj_parser(model, creating))
+  except ValueError, e:
+    raise BadRequestError('Invalid JSON body: %s' % e)
+  if isinstance(result, BadRequestError):
+    raise result
+  if not isinstance(result, (EntityDict, list)):
+    raise BadRequestError('Body must be a jobj or a list of jobjs')
+  return result
+
+
+def missing_references(entity_dicts):
+  """ Find which entities referenced in dicts from parse_jobj don't exist.
+
+  Reference properties' values are parsed into keys without fetching the
+  entities they refer to; this function checks all of them at once, with
+  as few batched gets as the datastore allows.
+
+  Args:
+    entity_dicts: a list of dicts as returned by parse_jobj
+  Returns:
+    a set of the db.Keys, among the dicts' values, of missing entities
+  """
+  keys = set()
+  for entity_dict in entity_dicts:
+    for value in entity_dict.itervalues():
+      if isinstance(value, db.Key):
+        keys.add(value)
+  keys = list(keys)
+  missing = set()
+  for i in range(0, len(keys), MAX_BATCH_SIZE):
+    batch = keys[i:i+MAX_BATCH_SIZE]
+    for key, entity in zip(batch, db.get(batch)):
+      if entity is None:
+        missing.add(key)
+  return missing
+
+
+def _check_references(entity_dict, missing):
+  """ Raise BadRequestError if entity_dict refers to keys in missing. """
+  if not missing: return
+  for property_name, value in entity_dict.iteritems():
+    if isinstance(value, db.Key) and value in missing:
+      raise BadRequestError('Property %r refers to missing entity %s' % (
+          property_name, restutil.classAndIdFromKey(value) or value))
+
+
+def _new_entity(model, entity_dict):
+  """ Makes (but does not put) an entity of type model w/state per dict. """
+  try:
+    return model(**entity_dict)
+  except db.BadValueError, e:
+    raise BadRequestError(str(e))
+
+
+def put_entities(entities):
+  """ Puts entities with as few batched puts as the datastore allows.
+
+  Args:
+    entities: a list of entities
+  Side effects:
+    puts the entities, in batches of at most MAX_BATCH_SIZE
+  """
+  for i in range(0, len(entities), MAX_BATCH_SIZE):
+    db.put(entities[i:i+MAX_BATCH_SIZE])
+
+
+def make_entity(model, jobj, check_refs=False, minimal=False):
   """ Makes an entity whose type is model with the state given by jobj.
 
   Args:
     model: a Model
     jobj: a jobj
+    check_refs: bool: if True, entities referenced by jobj must exist
+    minimal: bool: if True, return an id-only jobj
   Side effects:
     creates and puts an entity of type model, w/state per jobj
   Returns:
     a jobj representing the newly created entity
+  Raises:
+    BadRequestError if jobj can't be parsed into a valid entity
   """
-  entity_dict = parse_jobj(model, jobj)
-  entity = model(**entity_dict)
+  entity_dict = _parse(model, jobj, creating=True)
+  if check_refs:
+    _check_references(entity_dict, missing_references([entity_dict]))
+  entity = _new_entity(model, entity_dict)
   entity.put()
-  jobj = make_jobj(entity)
-  jobj.update(id_of(entity))
-  return jobj
+  if minimal:
+    return id_of(entity)
+  return make_jobj(entity)
+
+
+def make_entities(model, jobjs, atomic=False, check_refs=False,
+                  minimal=False):
+  """ Makes entities whose type is model with the states given by jobjs.
+
+  Args:
+    model: a Model
+    jobjs: a list of jobjs
+    atomic: bool: if True, any bad jobj fails the whole batch
+    check_refs: bool: if True, entities referenced by jobjs must exist
+      (all are checked together, with batched gets)
+    minimal: bool: if True, return id-only jobjs
+  Side effects:
+    creates and puts (with batched puts) an entity of type model per valid
+    jobj (none at all, if atomic and any jobj is invalid)
+  Returns:
+    a list with, for each jobj in order, a jobj representing the newly
+    created entity or, for an invalid jobj, a {'error': <message>} dict
+  Raises:
+    BadRequestError if atomic and any jobj can't be parsed into an entity
+  """
+  parsed = []
+  for jobj in jobjs:
+    try:
+      parsed.append(_parse(model, jobj, creating=True))
+    except BadRequestError, e:
+      parsed.append(e)
+  if check_refs:
+    missing = missing_references([entity_dict for entity_dict in parsed
+                                  if isinstance(entity_dict, dict)])
+  else:
+    missing = None
+  entities = []
+  results = []
+  for i, entity_dict in enumerate(parsed):
+    try:
+      if isinstance(entity_dict, BadRequestError):
+        raise entity_dict
+      _check_references(entity_dict, missing)
+      entity = _new_entity(model, entity_dict)
+    except BadRequestError, e:
+      if atomic:
+        raise BadRequestError('Item %d: %s' % (i, e))
+      results.append(dict(error=str(e)))
+    else:
+      entities.append(entity)
+      results.append(entity)
+  put_entities(entities)
+  if minimal: to_jobj = id_of
+  else: to_jobj = make_jobj
+  for i, result in enumerate(results):
+    if isinstance(result, db.Model):
+      results[i] = to_jobj(result)
+  return results
+
+
+def _set_properties(entity, entity_dict):
+  """ Sets (but does not put) an entity's properties given in the dict.
+
+  Returns:
+    a list of the names of the properties whose value changed (compared in
+    datastore form, so references are compared as keys, w/o dereferencing)
+  """
+  properties = type(entity).properties()
+  changed = []
+  try:
+    for property_name, property_value in entity_dict.iteritems():
+      prop = properties[property_name]
+      old_value = prop.get_value_for_datastore(entity)
+      setattr(entity, property_name, property_value)
+      if prop.get_value_for_datastore(entity) != old_value:
+        changed.append(property_name)
+  except db.BadValueError, e:
+    raise BadRequestError(str(e))
+  return changed
+
+
+def save_changes(entity, jobj, check_refs=False):
+  """ Updates an entity's state as per properties given in jobj, putting it
+  only if that changes anything.
+
+  Args:
+    entity: an entity
+    jobj: a jobj
+    check_refs: bool: if True, entities referenced by jobj must exist
+  Side effects:
+    updates the entity with properties as given by jobj; if any changed,
+    puts it (and invalidates its cached state)
+  Returns:
+    a list of the names of the properties that changed (empty if none did,
+    i.e. if jobj matches the entity's stored state and it wasn't put)
+  Raises:
+    BadRequestError if jobj can't be parsed into valid property values
+  """
+  entity_dict = _parse(type(entity), jobj)
+  if check_refs:
+    _check_references(entity_dict, missing_references([entity_dict]))
+  changed = _set_properties(entity, entity_dict)
+  if changed:
+    entity.put()
+    _invalidate(type(entity), [restutil.id_of(entity)])
+  return changed
 
 
-def update_entity(entity, jobj):
+def update_entity(entity, jobj, check_refs=False, minimal=False):
   """ Updates an entity's state as per properties given in jobj.
 
+  A thin wrapper of save_changes, for callers that want the new jobj back
+  rather than the names of the properties that changed.
+
   Args:
     entity: an entity
     jobj: a jobj
+    check_refs: bool: if True, entities referenced by jobj must exist
+    minimal: bool: if True, return an id-only jobj
   Side effects:
-    updates the entity with properties as given by jobj
+    updates the entity with properties as given by jobj, and puts it if
+    that changed anything (see save_changes)
   Returns:
     a jobj representing the whole new state of the entity
+  Raises:
+    BadRequestError if jobj can't be parsed into valid property values
   """
-  new_entity_data = parse_jobj(type(entity), jobj)
-  for property_name, property_value in new_entity_data.iteritems():
-    setattr(entity, property_name, property_value)
-  entity.put()
+  save_changes(entity, jobj, check_refs)
+  if minimal:
+    return id_of(entity)
   return make_jobj(entity)
+
+
+def update_entities(model, jobjs, atomic=False, check_refs=False,
+                    minimal=False):
+  """ Updates entities of type model as per the jobjs (with their ids).
+
+  Args:
+    model: a Model
+    jobjs: a list of jobjs, each with the 'id' of the entity to update
+    atomic: bool: if True, any bad jobj (or missing entity) fails them all
+    check_refs: bool: if True, entities referenced by jobjs must exist
+      (all are checked together, with batched gets)
+    minimal: bool: if True, return id-only jobjs
+  Side effects:
+    gets all entities to update with batched gets (from the datastore, not
+    the cache), then updates and puts (with batched puts) those whose jobj
+    is valid (none at all, if atomic and any jobj is invalid or any entity
+    is missing) and changes them
+  Returns:
+    a 2-item tuple (results, unchanged): results is a list with, for each
+    jobj in order, a jobj representing the whole new state of the entity
+    or, for an invalid jobj or missing entity, a {'error': <message>} dict;
+    unchanged is a list of the IDs of the entities that their (valid) jobj
+    changed nothing in, so that they weren't put
+  Raises:
+    BadRequestError if atomic and any jobj can't be applied to its entity
+  """
+  parsed = []
+  ids = []
+  for jobj in jobjs:
+    try:
+      entity_dict = _parse(model, jobj)
+      try:
+        numid = int(entity_dict.id)
+      except (TypeError, ValueError):
+        raise BadRequestError('A jobj must have a numeric id')
+    except BadRequestError, e:
+      parsed.append(e)
+    else:
+      parsed.append((numid, entity_dict))
+      ids.append(numid)
+  entities = iter(get_entities(model, ids, fresh=True))
+  if check_refs:
+    missing = missing_references([item[1] for item in parsed
+                                  if isinstance(item, tuple)])
+  else:
+    missing = None
+  to_put = []
+  unchanged = []
+  results = []
+  for i, item in enumerate(parsed):
+    try:
+      if isinstance(item, BadRequestError):
+        raise item
+      numid, entity_dict = item
+      entity = entities.next()
+      if entity is None:
+        raise BadRequestError('Entity %s/%s not found' % (
+            restutil.nameFromModelClass(model), numid))
+      _check_references(entity_dict, missing)
+      changed = _set_properties(entity, entity_dict)
+    except BadRequestError, e:
+      if atomic:
+        raise BadRequestError('Item %d: %s' % (i, e))
+      results.append(dict(error=str(e)))
+    else:
+      if changed:
+        to_put.append(entity)
+      else:
+        unchanged.append(numid)
+      results.append(entity)
+  put_entities(to_put)
+  _invalidate(model, [restutil.id_of(entity) for entity in to_put])
+  if minimal: to_jobj = id_of
+  else: to_jobj = make_jobj
+  for i, result in enumerate(results):
+    if isinstance(result, db.Model):
+      results[i] = to_jobj(result)
+  return results, unchanged
+
+
+def delete_entity(entity):
+  """ Deletes an entity.
+
+  Args:
+    entity: an entity
+  Side effects:
+    deletes the entity (from the datastore and the cache)
+  """
+  entity.delete()
+  _invalidate(type(entity), [restutil.id_of(entity)])
+
+
+def delete_entities(model, ids):
+  """ Deletes entities of a model given their numeric IDs.
+
+  Entities are deleted by key, with batched deletes, so none is fetched;
+  IDs of missing entities are just ignored (as deletion is idempotent).
+
+  Args:
+    model: a Model
+    ids: a list of ints
+  Side effects:
+    deletes the entities of model with those ids (from datastore and cache)
+  """
+  keys = [db.Key.from_path(model.kind(), numid) for numid in ids]
+  for i in range(0, len(keys), MAX_BATCH_SIZE):
+    db.delete(keys[i:i+MAX_BATCH_SIZE])
+  _invalidate(model, ids)
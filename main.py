@@ -19,14 +19,25 @@ class CrudRestHandler(webapp.RequestHandler, cookutil.CookieMixin):
     counter = self.get_cookie('counter')
     if counter: self.set_cookie('counter', str(int(counter) + 1))
     else: self.set_cookie('counter', '0')
-    return jsonutil.send_json(self.response, data)
+    return jsonutil.send_json(self.response, data, self.request)
 
-  def _get_model_and_entity(self, need_model, need_id):
+  def _minimal(self):
+    """ Does the request prefer a minimal (id-only) response to a write?
+        If so, says the preference is applied, in a response header.
+    """
+    if jsonutil.return_param(self.request) != 'minimal':
+      return False
+    self.response.headers['Preference-Applied'] = 'return=minimal'
+    return True
+
+  def _get_model_and_entity(self, need_model, need_id, fresh=False):
     """ Analyze self.request.path to get model and entity.
 
     Args:
       need_model: bool: if True, fail if classname is missing
       need_id: bool: if True, fail if ID is missing
+      fresh: bool: if True, get the entity from the datastore, not the
+        cache (as must be done for entities that will be modified)
 
     Returns 3-item tuple:
       failed: bool: True iff has failed
@@ -53,7 +64,7 @@ class CrudRestHandler(webapp.RequestHandler, cookutil.CookieMixin):
       self.response.set_status(400, 'ID %r is not numeric.' % strid)
       return True, model, None
     else:
-      entity = model.get_by_id(numid)
+      entity = jsonutil.get_entity(model, numid, fresh)
       if entity is None:
         self.response.set_status(404, "Entity %s not found" % self.request.path)
         return True, model, None
@@ -65,7 +76,13 @@ class CrudRestHandler(webapp.RequestHandler, cookutil.CookieMixin):
     Depending on the request path, serve as JSON to the response object:
     - for a path of /classname/id, a jobj for that entity
     - for a path of /classname, a list of id-only jobjs for that model
+      (a page of them, as per ?limit= and ?cursor=, w/Link to next page,
+      filtered as per any ?prop=value or ?prop__op=value, sorted as per
+      any ?order=prop,-prop..., see queryutil)
     - for a path of /, a list of all model classnames
+    For entities and collections, ?fields=prop,... limits jobjs to the given
+    properties (and id), ?expand=rel,... embeds related entities' jobjs (for
+    a collection, either makes its jobjs complete ones, not id-only ones).
     """
     coon = str(1 + int(self.get_cookie('coon', '0')))
     self.set_cookie('count', coon)
@@ -75,8 +92,22 @@ class CrudRestHandler(webapp.RequestHandler, cookutil.CookieMixin):
     if model is None:
       return self._serve(restutil.allModelClassNames())
     if entity is None:
-      return self._serve([jsonutil.id_of(x) for x in model.all()])
-    jobj = jsonutil.make_jobj(entity)
+      try:
+        jobjs = jsonutil.list_model(model, self.request, self.response)
+      except jsonutil.BadRequestError, e:
+        self.response.set_status(400, str(e))
+        return
+      return self._serve(jobjs)
+    try:
+      fields = jsonutil.fields_params(model, self.request)
+      expand = jsonutil.expand_params(model, self.request)
+    except jsonutil.BadRequestError, e:
+      self.response.set_status(400, str(e))
+      return
+    if expand:
+      jobj = jsonutil.make_jobjs(model, [entity], expand, fields)[0]
+    else:
+      jobj = jsonutil.encode_entity(entity, fields)
     return self._serve(jobj)
 
   def post(self):
@@ -85,14 +116,33 @@ class CrudRestHandler(webapp.RequestHandler, cookutil.CookieMixin):
         Request body is JSON for a jobj for a new entity (without id!).
         Response is JSON for a jobj for a newly created entity.
         Also sets HTTP Location: header to /classname/id for new entity.
+        Request body may also be a list of jobjs: then, response is a list
+        of new entities' jobjs, or {"error": ...} for invalid ones (with
+        ?atomic=1, any invalid one fails them all), and there's no Location.
+        With ?check_refs=1, entities referenced in the body must all exist.
+        With ?return=minimal (or header Prefer: return=minimal), jobjs in
+        the response are id-only.
     """
     failed, model, entity = self._get_model_and_entity(True, False)
     if failed: return
     if entity is not None:
       self.response.set_status(400, 'Cannot create entity with fixed ID.')
       return
-    jobj = jsonutil.receive_json(self.request)
-    jobj = jsonutil.make_entity(model, jobj)
+    check_refs = jsonutil.flag_param(self.request, 'check_refs')
+    minimal = self._minimal()
+    try:
+      jobj = jsonutil.receive_entity_dicts(self.request, model, creating=True)
+      if isinstance(jobj, list):
+        atomic = jsonutil.flag_param(self.request, 'atomic')
+        jobjs = jsonutil.make_entities(model, jobj, atomic, check_refs,
+                                       minimal)
+      else:
+        jobj = jsonutil.make_entity(model, jobj, check_refs, minimal)
+    except jsonutil.BadRequestError, e:
+      self.response.set_status(400, str(e))
+      return
+    if isinstance(jobj, list):
+      return self._serve(jobjs)
     self._serve(jobj)
     new_entity_path = "/%s/%s" % (self._classname, jobj['id'])
     logging.info('Post created %r', new_entity_path)
@@ -104,23 +154,45 @@ class CrudRestHandler(webapp.RequestHandler, cookutil.CookieMixin):
 
         Request body is JSON for a jobj for an existing entity.
         Response is JSON for a jobj for the updated entity.
+        With ?check_refs=1, entities referenced in the body must all exist.
+        If the body changes nothing, the entity isn't put, the status
+        message says "Unchanged" rather than "Updated", and the response's
+        header X-Unchanged-Ids is the entity's ID.
+        With ?return=minimal (or header Prefer: return=minimal), the jobj
+        in the response is id-only, and Location is set to the entity.
     """
-    failed, model, entity = self._get_model_and_entity(True, True)
+    failed, model, entity = self._get_model_and_entity(True, True, True)
     if failed: return
-    jobj = jsonutil.receive_json(self.request)
-    jobj = jsonutil.update_entity(entity, jobj)
+    check_refs = jsonutil.flag_param(self.request, 'check_refs')
+    try:
+      jobj = jsonutil.receive_entity_dicts(self.request, model)
+      changed = jsonutil.save_changes(entity, jobj, check_refs)
+    except jsonutil.BadRequestError, e:
+      self.response.set_status(400, str(e))
+      return
+    minimal = self._minimal()
+    if minimal:
+      jobj = jsonutil.id_of(entity)
+    else:
+      jobj = jsonutil.make_jobj(entity)
     self._serve(jobj)
     updated_entity_path = "/%s/%s" % (self._classname, jobj['id'])
-    self.response.set_status(200, 'Updated entity %s' % updated_entity_path)
+    if minimal:
+      self.response.headers['Location'] = updated_entity_path
+    if changed:
+      self.response.set_status(200, 'Updated entity %s' % updated_entity_path)
+    else:
+      jsonutil.set_unchanged(self.response, [jobj['id']])
+      self.response.set_status(200, 'Unchanged entity %s' % updated_entity_path)
 
   def delete(self):
     """ Delete an entity of model given by path /classname/id.
 
         Response is JSON for an empty jobj.
     """
-    failed, model, entity = self._get_model_and_entity(True, True)
+    failed, model, entity = self._get_model_and_entity(True, True, True)
     if failed: return
-    entity.delete()
+    jsonutil.delete_entity(entity)
     self._serve({})
 
 
@@ -2,6 +2,8 @@
 """
 import logging
 from google.appengine.ext import db
+import cacheutil
+import queryutil
 import restutil
 
 
@@ -30,3 +32,16 @@ class Pager(db.Model):
 
 restutil.decorateModuleNamed(__name__)
 logging.info('Models in %r decorated', __name__)
+
+# cache entities (and their JSON) briefly in-process, longer in memcache
+_backend = cacheutil.ChainBackend(cacheutil.LruBackend(size=1000, ttl=10),
+                                  cacheutil.MemcacheBackend())
+cacheutil.entity_cache = cacheutil.EntityCache(_backend)
+cacheutil.json_cache = cacheutil.JsonCache(_backend)
+restutil.registerSpecialByName('$cache')
+restutil.registerSpecialMethod('$cache', 'stats', cacheutil.stats)
+
+# which composite indexes do queries need? (GET /$indexes/yaml for index.yaml)
+restutil.registerSpecialByName('$indexes')
+restutil.registerSpecialMethod('$indexes', 'needed', queryutil.needed_indexes)
+restutil.registerSpecialMethod('$indexes', 'yaml', queryutil.needed_index_yaml)
@@ -106,6 +106,8 @@ class RestUrlParser(UrlParser):
   ('model_method', 'foobar', 'zak')
   >>> h.process('/foobar/23/')
   ('model_strid', 'foobar', '23')
+  >>> h.process('/foobar/23,5,23')
+  ('model_strids', 'foobar', '23,5,23')
   >>> h.process('/foobar/23/blop')
   ('model_strid_method', 'foobar', '23', 'blop')
   >>> h.process('')
@@ -137,14 +139,16 @@ class RestUrlParser(UrlParser):
           do_special_method(special, method)
           do_model_method(model, method)
           do_model_strid(model, strid)
+          do_model_strids(model, strids)
           do_model_strid_method(model, strid, method)
 
         The *names* (not necessarily the *order*) of the arguments matter.
 
         The values of all arguments are strings (the substrings of the
           incoming path that match the respective items of the REST URL):
-            strid is always 1+ digits; special is '$' + a valid identifier;
-            model and method are identifiers.
+            strid is always 1+ digits; strids is 2+ strids joined by commas;
+            special is '$' + a valid identifier; model and method are
+            identifiers.
     """
     # let each method be overridden (in the instance) by caller at ctor-time
     self.__dict__.update(overrides)
@@ -158,6 +162,7 @@ class RestUrlParser(UrlParser):
 
     sr_method = r'/(?P<method>\w+)'
     sr_strid = r'/(?P<strid>\d+)'
+    sr_strids = r'/(?P<strids>\d+(?:,\d+)+)'
 
     # special_method must be before special (ie. special_method > special)
     re_special = r'(?P<special>\$\w+)/?'
@@ -165,12 +170,14 @@ class RestUrlParser(UrlParser):
     addurl('special_method', re_special_method)
     addurl('special', re_special)
 
-    # model_strid_method > model_strid > model_method > model
+    # model_strid_method > model_strids > model_strid > model_method > model
     re_model = r'(?P<model>\w+)/?'
     re_model_method = re_model + sr_method
     re_model_strid = re_model + sr_strid
+    re_model_strids = re_model + sr_strids
     re_model_strid_method = re_model_strid + sr_method
     addurl('model_strid_method', re_model_strid_method)
+    addurl('model_strids', re_model_strids)
     addurl('model_strid', re_model_strid)
     addurl('model_method', re_model_method)
     addurl('model', re_model)
@@ -187,6 +194,8 @@ class RestUrlParser(UrlParser):
     return 'model_method', model, method
   def do_model_strid(self, model, strid):
     return 'model_strid', model, strid
+  def do_model_strids(self, model, strids):
+    return 'model_strids', model, strids
   def do_model_strid_method(self, model, strid, method):
     return 'model_strid_method', model, strid, method
 
@@ -0,0 +1,325 @@
+''' Utilities to make datastore queries from REST query strings.
+
+This module translates the query string of a GET on a collection (e.g.
+/Doctor?name=Dr.%20Who or /Pager?number__ge=555&order=-number) into a
+db.Query for the model, with each value converted by the property's
+_from_string method (see restutil), so filtering and sorting run on the
+datastore's indexes.
+
+A filter parameter is named after a property, optionally followed by __ and
+an operator: eq (the default), lt, le, gt or ge.  Parameter order is a
+comma-separated list of property names to sort by, each prefixed with - to
+sort in descending order.  Parameters whose names are in RESERVED_PARAMS
+(or start with _) are not filters.  No parameter may be given more than once:
+list-valued filters (e.g. ?name=a&name=b) are not supported, and give a
+BadQueryError rather than a query silently matching nothing (or dropping
+values).
+
+Queries are checked before being run, so that those the datastore could not
+serve from its indexes fail fast with a BadQueryError, rather than failing
+(or scanning) later:
+  -- properties that are not indexed (e.g. TextProperty) can't be filtered on
+  -- inequality filters can only be on a single property, which must also be
+     the first one sorted on, if the query is sorted at all
+  -- queries needing a composite index must find it among those declared in
+     index.yaml (see declared_indexes)
+Composite indexes that queries needed are counted (declared or not), so that
+needed_indexes and needed_index_yaml can tell which ones traffic really uses.
+'''
+import logging
+import os
+
+from google.appengine.ext import db
+
+import restutil
+
+
+class BadQueryError(ValueError):
+  """ A query string can't be turned into a query that indexes can serve. """
+
+
+# query-string parameters which are never filters (all those that handlers
+# read, on any request)
+RESERVED_PARAMS = frozenset(('limit', 'cursor', 'fields', 'expand', 'order',
+                             'return', 'atomic', 'check_refs'))
+
+# operator suffixes (after __) of filter parameters -> datastore operators
+OPERATORS = {
+  'eq': '=',
+  'lt': '<',
+  'le': '<=',
+  'gt': '>',
+  'ge': '>=',
+}
+
+# path of the index.yaml file declaring composite indexes
+INDEX_YAML_PATH = 'index.yaml'
+
+# if False, queries needing undeclared composite indexes are let through
+# (e.g. to let dev_appserver add them to an AUTOGENERATED index.yaml)
+check_indexes = True
+
+
+def isIndexed(prop):
+  """ Is a property (a db.Property instance) indexed by the datastore? """
+  if isinstance(prop, (db.TextProperty, db.BlobProperty)):
+    return False
+  return getattr(prop, 'indexed', True)
+
+
+def parse_filters(model, params):
+  """ Get the filters given by query-string parameters for a model.
+
+  Args:
+    model: a Model
+    params: a list of (name, value) pairs of query-string parameters
+  Returns:
+    a list of (property_name, operator, value) triples, operator being one
+    of OPERATORS' values and value the result of the property's _from_string
+  Raises:
+    BadQueryError for unknown properties or operators, unindexed properties,
+    values _from_string can't convert, or filters given more than once
+  """
+  setters = restutil.propertySetters(model)
+  properties = model.properties()
+  filters = []
+  seen = set()
+  for name, value in params:
+    if name in RESERVED_PARAMS or name.startswith('_'):
+      continue
+    property_name, sep, opname = name.partition('__')
+    try:
+      property_name, from_string, required = setters[property_name]
+    except KeyError:
+      raise BadQueryError('Unknown property %r for model %s' % (
+          property_name, restutil.nameFromModelClass(model)))
+    operator = OPERATORS.get(opname or 'eq')
+    if operator is None:
+      raise BadQueryError('Unknown operator %r (known: %s)' % (
+          opname, ', '.join(sorted(OPERATORS))))
+    if (property_name, operator) in seen:
+      raise BadQueryError('Filter %r given more than once (list-valued '
+                          'filters are not supported)' % name)
+    seen.add((property_name, operator))
+    if not isIndexed(properties[property_name]):
+      raise BadQueryError('Property %r is not indexed, cannot filter on it'
+                          % property_name)
+    try:
+      value = from_string(value)
+    except Exception, e:
+      raise BadQueryError('Bad value %r for property %r: %s' % (
+          value, property_name, e))
+    filters.append((property_name, operator, value))
+  return filters
+
+
+def parse_orders(model, order):
+  """ Get the sort orders given by an order query-string parameter.
+
+  Args:
+    model: a Model
+    order: a str, comma-separated property names, each optionally prefixed
+      with - (for a descending order), e.g. '-number,doctor'
+  Returns:
+    a list of (property_name, direction) pairs, direction 'asc' or 'desc'
+  Raises:
+    BadQueryError for unknown or unindexed properties, or repeated ones
+  """
+  properties = model.properties()
+  orders = []
+  seen = set()
+  for name in order.split(','):
+    name = name.strip()
+    if not name: continue
+    if name.startswith('-'):
+      name, direction = name[1:], 'desc'
+    else:
+      direction = 'asc'
+    prop = properties.get(name)
+    if prop is None:
+      raise BadQueryError('Unknown property %r for model %s' % (
+          name, restutil.nameFromModelClass(model)))
+    if not isIndexed(prop):
+      raise BadQueryError('Property %r is not indexed, cannot order by it'
+                          % name)
+    if name in seen:
+      raise BadQueryError('Property %r ordered by more than once' % name)
+    seen.add(name)
+    orders.append((prop.name, direction))
+  return orders
+
+
+def required_index(filters, orders=()):
+  """ Get the composite index a query with the given filters and sort
+  orders needs, if any.
+
+  The datastore serves equality filters (even on several properties), an
+  inequality filter on one property, and a single sort order (on that same
+  property, if there's an inequality filter) from its built-in indexes, but
+  needs a composite index for anything more.  Sort orders on properties with
+  equality filters make no difference, so they're ignored.
+
+  Args:
+    filters: a list of (property_name, operator, value) triples
+    orders: a list of (property_name, direction) pairs
+  Returns:
+    None if built-in indexes suffice, else a pair (equality_names, rest):
+    a frozenset of the names of properties with equality filters (which may
+    come in any order in the index), and a tuple of (name, direction) pairs
+    for the properties that must follow them, direction 'asc' or 'desc'
+  Raises:
+    BadQueryError if inequality filters are on more than one property, or
+    the query is sorted first on a property other than the inequality one
+  """
+  equalities = frozenset([name for name, operator, value in filters
+                          if operator == '='])
+  inequalities = frozenset([name for name, operator, value in filters
+                            if operator != '='])
+  if len(inequalities) > 1:
+    raise BadQueryError('Inequality filters must all be on one property, '
+                        'not on %s' % ', '.join(sorted(inequalities)))
+  orders = [(name, direction) for name, direction in orders
+            if name not in equalities]
+  if inequalities:
+    inequality = iter(inequalities).next()
+    if not orders:
+      orders = [(inequality, 'asc')]
+    elif orders[0][0] != inequality:
+      raise BadQueryError('With an inequality filter on %r, the first '
+                          'order must be on %r too' % (inequality, inequality))
+  if not orders or (not equalities and len(orders) == 1):
+    return None
+  return equalities, tuple(orders)
+
+
+_declared = None
+
+def declared_indexes():
+  """ Get the composite indexes declared in INDEX_YAML_PATH (loaded once).
+
+  Returns:
+    a list of (kind, properties) pairs, properties being a tuple of (name,
+    direction) pairs, direction 'asc' or 'desc' (ancestor indexes are not
+    listed, as queries made by this module never use ancestors)
+  """
+  global _declared
+  if _declared is None:
+    from google.appengine.api import datastore_index
+    _declared = []
+    if os.path.exists(INDEX_YAML_PATH):
+      definitions = datastore_index.ParseIndexDefinitions(
+          open(INDEX_YAML_PATH))
+      for index in (definitions and definitions.indexes) or ():
+        if index.ancestor: continue
+        properties = tuple([(prop.name, prop.direction or 'asc')
+                            for prop in index.properties or ()])
+        _declared.append((index.kind, properties))
+    else:
+      logging.warning('No %r, so no composite indexes', INDEX_YAML_PATH)
+  return _declared
+
+
+def is_declared(kind, index):
+  """ Is a composite index (as from required_index) declared for a kind? """
+  equalities, rest = index
+  for declared_kind, properties in declared_indexes():
+    if declared_kind != kind or len(properties) != len(equalities) + len(rest):
+      continue
+    head = properties[:len(equalities)]
+    if (frozenset([name for name, direction in head]) == equalities and
+        properties[len(equalities):] == rest):
+      return True
+  return False
+
+
+# (kind, index) -> number of queries that needed that composite index, index
+# being as from required_index
+_needed = dict()
+
+def _properties_of(index):
+  """ (name, direction) pairs of an index, equality ones sorted by name. """
+  equalities, rest = index
+  return tuple([(name, 'asc') for name in sorted(equalities)]) + rest
+
+
+def _note_needed(kind, index):
+  """ Count a query's need for a composite index (logging the first one). """
+  key = kind, index
+  if key not in _needed:
+    logging.info('Query needs composite index %s(%s)', kind,
+                 ', '.join(['%s %s' % prop for prop in _properties_of(index)]))
+    _needed[key] = 0
+  _needed[key] += 1
+
+
+def needed_indexes():
+  """ Get the composite indexes that queries needed, most needed first.
+
+  Returns:
+    a list of JSONable dicts, each with keys kind, properties (a list of
+    {'name': ..., 'direction': ...} dicts), count (number of queries that
+    needed the index) and declared (bool: is it in INDEX_YAML_PATH?)
+  """
+  result = []
+  for (kind, index), count in _needed.iteritems():
+    result.append(dict(kind=kind, count=count,
+        properties=[dict(name=name, direction=direction)
+                    for name, direction in _properties_of(index)],
+        declared=is_declared(kind, index)))
+  result.sort(key=lambda d: (-d['count'], d['kind']))
+  return result
+
+
+def needed_index_yaml():
+  """ Get index.yaml text declaring the composite indexes queries needed. """
+  lines = ['indexes:']
+  for index in needed_indexes():
+    lines.append('')
+    lines.append('# needed by %d queries%s' % (index['count'],
+                 ('', ' (declared)')[index['declared']]))
+    lines.append('- kind: %s' % index['kind'])
+    lines.append('  properties:')
+    for prop in index['properties']:
+      lines.append('  - name: %s' % prop['name'])
+      if prop['direction'] == 'desc':
+        lines.append('    direction: desc')
+  return '\n'.join(lines) + '\n'
+
+
+def make_query(model, params, keys_only=False):
+  """ Make a query for the entities of a model given query-string params.
+
+  Args:
+    model: a Model
+    params: a list of (name, value) pairs of query-string parameters
+    keys_only: bool: if True, make a keys-only query
+  Returns:
+    a db.Query for model, filtered and sorted as per params
+  Raises:
+    BadQueryError if params can't give a query the datastore can serve from
+    its (built-in or declared) indexes, or if any reserved one is repeated
+  Side effects:
+    counts the composite index the query needs, if any
+  """
+  filters = parse_filters(model, params)
+  orders = []
+  seen = set()
+  for name, value in params:
+    if name not in RESERVED_PARAMS: continue
+    if name in seen:
+      raise BadQueryError('Parameter %r given more than once' % name)
+    seen.add(name)
+    if name == 'order':
+      orders = parse_orders(model, value)
+  index = required_index(filters, orders)
+  if index is not None:
+    _note_needed(model.kind(), index)
+    if check_indexes and not is_declared(model.kind(), index):
+      raise BadQueryError('Query needs a composite index not in %s' %
+                          INDEX_YAML_PATH)
+  query = model.all(keys_only=keys_only)
+  for property_name, operator, value in filters:
+    query.filter('%s %s' % (property_name, operator), value)
+  for property_name, direction in orders:
+    query.order(('', '-')[direction == 'desc'] + property_name)
+  return query
@@ -41,6 +41,7 @@ import inspect
 import logging
 import sys
 
+import codecutil
 from google.appengine.ext import db
 from google.appengine.api import users
 
@@ -212,6 +213,46 @@ def modelInstanceByClassAndId(s):
   if theclass is None: return None
   return theclass.get_by_id(int(theid))
 
+def keyFromClassAndId(s):
+  """ Get a model instance's key given its class name and numeric ID.
+
+      Unlike modelInstanceByClassAndId, this does not fetch the instance (nor
+      check that it exists), so it's what reference properties are set from.
+
+      Args:
+        s: str of the form 'Classname/1234'
+      Returns:
+        db.Key for the instance of the class of that name, with that ID
+      Raises:
+        ValueError if s is malformed or names no registered class
+  """
+  classname, theid = s.split('/')
+  theclass = modelClassFromName(classname)
+  if theclass is None:
+    raise ValueError('No model named %r' % classname)
+  return db.Key.from_path(theclass.kind(), int(theid))
+
+def referenceFromString(reference_class):
+  """ Make a keyFromClassAndId for a reference property of a given class.
+
+      A db.ReferenceProperty accepts any db.Key, whatever its kind, so the
+      function made checks the class named in its str argument instead (no
+      fetch needed).
+
+      Args:
+        reference_class: the reference property's reference_class
+      Returns:
+        a function like keyFromClassAndId, which also raises ValueError if
+        the class named is neither reference_class nor a subclass of it
+  """
+  def fromString(s):
+    key = keyFromClassAndId(s)
+    theclass = modelClassFromName(s.split('/')[0])
+    if not issubclass(theclass, reference_class):
+      raise ValueError('%r is not a %s' % (s, reference_class.__name__))
+    return key
+  return fromString
+
 def classAndIdFromModelInstance(x, classname=None):
   """ Get a string with class name and numeric ID given a model instance.
 
@@ -227,6 +268,27 @@ def classAndIdFromModelInstance(x, classname=None):
   return '%s/%s' % (classname, id_of(x))
 
 
+def classAndIdFromKey(key):
+  """ Get a string with class name and numeric ID given a key.
+
+      Unlike classAndIdFromModelInstance, this needs no entity, so reference
+      properties can be serialized from the key they store, without fetching
+      the entity they refer to.
+
+      Args:
+        key: a db.Key or None
+      Returns:
+        str of the form 'Classname/1234' (or None if key is None, or not
+        that of a registered class)
+  """
+  if key is None: return None
+  try: theclass = db.class_for_kind(key.kind())
+  except db.KindError: return None
+  classname = nameFromModelClass(theclass)
+  if classname is None or key.id() is None: return None
+  return '%s/%s' % (classname, key.id())
+
+
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 def datetimeFromString(s):
@@ -263,7 +325,7 @@ setter_registry = {
   db.DateTimeProperty: staticmethod(datetimeFromString),
   db.IntegerProperty: int,
   db.FloatProperty: float,
-  db.ReferenceProperty: staticmethod(modelInstanceByClassAndId),
+  db.ReferenceProperty: staticmethod(keyFromClassAndId),
   db.StringListProperty: str.split,
   db.UserProperty: users.User,
 }
@@ -290,11 +352,17 @@ def allProperties(cls):
 def addHelperMethods(cls):
   """ Add _from_string and _to_string methods to a db.Model subclass.
 
+      Also (re)compiles the class's serialization, JSON-encoding and parsing
+      plans (see propertyGetters, propertyEncoders and propertySetters).
+
       Args:
         cls: a class object (db.Model subclass), adds methods to it.
   """
   logging.info('decorating model %r', cls)
   props = allProperties(cls)
+  getters = []
+  setters = dict()
+  references = dict()
   for name, value in props:
     fs_name = name + '_from_string'
     if not hasattr(cls, fs_name):
@@ -306,6 +374,122 @@ def addHelperMethods(cls):
       getter = getter_registry.get(type(value), str)
       setattr(cls, ts_name, getter)
       # logging.info('added %r: %r', ts_name, getter)
+    to_string = getattr(cls, ts_name)
+    if to_string is classAndIdFromModelInstance:
+      # use the stored key, rather than dereferencing (i.e., fetching)
+      getters.append((name, classAndIdFromKey, value))
+    else:
+      getters.append((name, to_string, None))
+    # a required property with a default is filled in by db if not given
+    required = bool(value.required and value.default is None)
+    from_string = getattr(cls, fs_name)
+    if isinstance(value, db.ReferenceProperty):
+      references[name] = value
+      if from_string is keyFromClassAndId:
+        from_string = referenceFromString(value.reference_class)
+    setters[name] = name, from_string, required
+  cls._getters = tuple(getters)
+  cls._encoders = tuple([(name, ', %s: ' % codecutil.encode_string(name),
+                          to_string, raw_property)
+                         for name, to_string, raw_property in getters])
+  cls._setters = setters
+  cls._references = references
+
+def propertyGetters(cls):
+  """ Get the serialization plan of a db.Model subclass.
+
+      The plan is compiled by addHelperMethods (and recompiled only if the
+      class is decorated again), so callers avoid re-introspecting the class
+      and re-looking-up its _to_string methods for each entity.
+
+      Args:
+        cls: a class object (a db.Model subclass)
+      Returns:
+        tuple of (name, to_string, raw_property) triples, one per property
+        of that class: if raw_property is None, to_string takes the value of
+        the entity's attribute; otherwise, it takes the value that
+        raw_property.get_value_for_datastore(entity) returns (so that, e.g.,
+        reference properties are serialized from their keys)
+  """
+  # look in the class's own dict: a subclass must not use its base's plan
+  getters = cls.__dict__.get('_getters')
+  if getters is None:
+    addHelperMethods(cls)
+    getters = cls._getters
+  return getters
+
+def propertyEncoders(cls):
+  """ Get the JSON-encoding plan of a db.Model subclass.
+
+      Like propertyGetters' plan, this is compiled by addHelperMethods.
+
+      Args:
+        cls: a class object (a db.Model subclass)
+      Returns:
+        tuple of (name, fragment, to_string, raw_property) quadruples, one
+        per triple of propertyGetters' plan, fragment being the JSON text
+        that comes before the property's value in the entity's JSON object
+        (i.e. ', "name": ')
+  """
+  encoders = cls.__dict__.get('_encoders')
+  if encoders is None:
+    addHelperMethods(cls)
+    encoders = cls._encoders
+  return encoders
+
+def propertySetters(cls):
+  """ Get the parsing plan of a db.Model subclass.
+
+      Like propertyGetters' plan, this is compiled by addHelperMethods.
+
+      Args:
+        cls: a class object (a db.Model subclass)
+      Returns:
+        dict mapping each property name to a (name, from_string, required)
+        tuple (name is always a str, even when looked up by a unicode key;
+        required is True only for required properties with no default)
+  """
+  setters = cls.__dict__.get('_setters')
+  if setters is None:
+    addHelperMethods(cls)
+    setters = cls._setters
+  return setters
+
+def referenceProperties(cls):
+  """ Get the reference properties of a db.Model subclass.
+
+      Like propertyGetters' plan, this is compiled by addHelperMethods.
+
+      Args:
+        cls: a class object (a db.Model subclass)
+      Returns:
+        dict mapping the name of each reference property to the property
+  """
+  references = cls.__dict__.get('_references')
+  if references is None:
+    addHelperMethods(cls)
+    references = cls._references
+  return references
+
+def reverseReferences(cls):
+  """ Get the "reverse references" to a db.Model subclass.
+
+      These are the reference properties of registered classes which refer
+      specifically to cls, each giving cls a reverse-reference property
+      (named as the reference property's collection_name).
+
+      Args:
+        cls: a class object (a db.Model subclass)
+      Returns:
+        dict mapping each reverse-reference property name to a pair (model,
+        name): the class, and the name of its reference property to cls
+  """
+  result = dict()
+  for model in model_class_registry.itervalues():
+    for name, prop in referenceProperties(model).iteritems():
+      if prop.reference_class is cls:
+        result[prop.collection_name] = model, name
+  return result
 
 def decorateModuleNamed(module_name):
   """ Do all needed work for non-private model classes in module thus named. """
@@ -243,6 +243,126 @@ ANYTHING = [
 JSONScanner = Scanner(ANYTHING)
 
 
+NUMBER = re.compile(r'(-?(?:0|[1-9]\d*))(\.\d+)?([eE][-+]?\d+)?', FLAGS)
+
+def make_scanner(context, _w=WHITESPACE.match, _c=_CONSTANTS):
+    """
+    Return a ``scan_once(s, idx)`` function that decodes the JSON value
+    starting at ``s[idx]`` and returns a ``(value, end)`` 2-tuple, raising
+    ``StopIteration`` if no JSON value starts there.
+
+    Unlike ``JSONScanner``, this decodes by direct recursive descent,
+    dispatching on the character at ``idx``: it makes no generator (nor sre
+    scanner) per value.  The options of ``context`` (a ``JSONDecoder``) are
+    read once, when the function is made.
+    """
+    encoding = context.encoding
+    strict = context.strict
+    object_hook = context.object_hook
+    parse_float = context.parse_float or float
+    parse_int = context.parse_int or int
+    parse_constant = context.parse_constant or _c.__getitem__
+    match_number = NUMBER.match
+
+    def scan_once(s, idx):
+        try:
+            nextchar = s[idx]
+        except IndexError:
+            raise StopIteration
+        if nextchar == '"':
+            return scanstring(s, idx + 1, encoding, strict)
+        elif nextchar == '{':
+            return parse_object(s, idx + 1)
+        elif nextchar == '[':
+            return parse_array(s, idx + 1)
+        elif nextchar == 'n' and s[idx:idx + 4] == 'null':
+            return parse_constant('null'), idx + 4
+        elif nextchar == 't' and s[idx:idx + 4] == 'true':
+            return parse_constant('true'), idx + 4
+        elif nextchar == 'f' and s[idx:idx + 5] == 'false':
+            return parse_constant('false'), idx + 5
+        m = match_number(s, idx)
+        if m is not None:
+            integer, frac, exp = m.groups()
+            if frac or exp:
+                res = parse_float(integer + (frac or '') + (exp or ''))
+            else:
+                res = parse_int(integer)
+            return res, m.end()
+        elif nextchar == 'N' and s[idx:idx + 3] == 'NaN':
+            return parse_constant('NaN'), idx + 3
+        elif nextchar == 'I' and s[idx:idx + 8] == 'Infinity':
+            return parse_constant('Infinity'), idx + 8
+        elif nextchar == '-' and s[idx:idx + 9] == '-Infinity':
+            return parse_constant('-Infinity'), idx + 9
+        raise StopIteration
+
+    def parse_object(s, end):
+        pairs = {}
+        end = _w(s, end).end()
+        nextchar = s[end:end + 1]
+        # Trivial empty object
+        if nextchar == '}':
+            if object_hook is not None:
+                pairs = object_hook(pairs)
+            return pairs, end + 1
+        if nextchar != '"':
+            raise ValueError(errmsg("Expecting property name", s, end))
+        end += 1
+        while True:
+            key, end = scanstring(s, end, encoding, strict)
+            end = _w(s, end).end()
+            if s[end:end + 1] != ':':
+                raise ValueError(errmsg("Expecting : delimiter", s, end))
+            end = _w(s, end + 1).end()
+            try:
+                value, end = scan_once(s, end)
+            except StopIteration:
+                raise ValueError(errmsg("Expecting object", s, end))
+            pairs[key] = value
+            end = _w(s, end).end()
+            nextchar = s[end:end + 1]
+            end += 1
+            if nextchar == '}':
+                break
+            if nextchar != ',':
+                raise ValueError(errmsg("Expecting , delimiter", s, end - 1))
+            end = _w(s, end).end()
+            nextchar = s[end:end + 1]
+            end += 1
+            if nextchar != '"':
+                raise ValueError(errmsg("Expecting property name", s, end - 1))
+        if object_hook is not None:
+            pairs = object_hook(pairs)
+        return pairs, end
+
+    def parse_array(s, end):
+        values = []
+        end = _w(s, end).end()
+        # Look-ahead for trivial empty array
+        nextchar = s[end:end + 1]
+        if nextchar == ']':
+            return values, end + 1
+        append = values.append
+        while True:
+            try:
+                value, end = scan_once(s, end)
+            except StopIteration:
+                raise ValueError(errmsg("Expecting object", s, end))
+            append(value)
+            end = _w(s, end).end()
+            nextchar = s[end:end + 1]
+            end += 1
+            if nextchar == ']':
+                break
+            if nextchar != ',':
+                raise ValueError(errmsg("Expecting , delimiter", s, end))
+            end = _w(s, end).end()
+        return values, end
+
+    return scan_once
+
+
 class JSONDecoder(object):
     """
     Simple JSON <http://json.org> decoder
@@ -277,7 +397,7 @@ class JSONDecoder(object):
     __all__ = ['__init__', 'decode', 'raw_decode']
 
     def __init__(self, encoding=None, object_hook=None, parse_float=None,
-            parse_int=None, parse_constant=None, strict=True):
+            parse_int=None, parse_constant=None, strict=True, fast=True):
         """
         ``encoding`` determines the encoding used to interpret any ``str``
         objects decoded by this instance (utf-8 by default).  It has no
@@ -305,6 +425,10 @@ class JSONDecoder(object):
         following strings: -Infinity, Infinity, NaN, null, true, false.
         This can be used to raise an exception if invalid JSON numbers
         are encountered.
+
+        If ``fast`` is true (the default), decoding is by direct recursive
+        descent (see ``make_scanner``), which reads the options above once,
+        here; otherwise, by the (slower) iterator-based ``JSONScanner``.
         """
         self.encoding = encoding
         self.object_hook = object_hook
@@ -312,6 +436,10 @@ class JSONDecoder(object):
         self.parse_int = parse_int
         self.parse_constant = parse_constant
         self.strict = strict
+        if fast:
+            self.scan_once = make_scanner(self)
+        else:
+            self.scan_once = None
 
     def decode(self, s, _w=WHITESPACE.match):
         """
@@ -335,7 +463,10 @@ class JSONDecoder(object):
         """
         kw.setdefault('context', self)
         try:
-            obj, end = self._scanner.iterscan(s, **kw).next()
+            if self.scan_once is not None and kw['context'] is self:
+                obj, end = self.scan_once(s, kw.get('idx', 0))
+            else:
+                obj, end = self._scanner.iterscan(s, **kw).next()
         except StopIteration:
             raise ValueError("No JSON object could be decoded")
         return obj, end
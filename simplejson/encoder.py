@@ -59,6 +59,9 @@ def encode_basestring(s):
 def py_encode_basestring_ascii(s):
     if isinstance(s, str) and HAS_UTF8.search(s) is not None:
         s = s.decode('utf-8')
+    if ESCAPE_ASCII.search(s) is None:
+        # nothing to escape (as for most keys and values)
+        return '"' + str(s) + '"'
     def replace(match):
         s = match.group(0)
         try:
@@ -116,7 +119,8 @@ class JSONEncoder(object):
     key_separator = ': '
     def __init__(self, skipkeys=False, ensure_ascii=True,
             check_circular=True, allow_nan=True, sort_keys=False,
-            indent=None, separators=None, encoding='utf-8', default=None):
+            indent=None, separators=None, encoding='utf-8', default=None,
+            fast=True):
         """
         Constructor for JSONEncoder, with sensible defaults.
 
@@ -158,6 +162,10 @@ class JSONEncoder(object):
         If encoding is not None, then all input strings will be
         transformed into unicode using that encoding prior to JSON-encoding.
         The default is UTF-8.
+
+        If fast is True (the default) and indent is None, encoding is done
+        in a single pass that appends all chunks to one list (see
+        _make_fast_encoder), rather than through nested generators.
         """
 
         self.skipkeys = skipkeys
@@ -172,6 +180,7 @@ class JSONEncoder(object):
         if default is not None:
             self.default = default
         self.encoding = encoding
+        self.fast = fast
 
     def _newline_indent(self):
         return '\n' + (' ' * (self.indent * self.current_indent_level))
@@ -318,6 +327,137 @@ class JSONEncoder(object):
             if markers is not None:
                 del markers[markerid]
 
+    def _make_fast_encoder(self, append, markers=None):
+        """
+        Return a function that encodes an object by calling ``append`` (e.g.
+        a list's ``append`` method) with each chunk, recursing directly
+        rather than through generators.  Does not support ``indent``.
+
+        Strings in lists and dicts are encoded inline, and each item of a
+        dict whose value is a string is appended as a single chunk, so
+        flat ``{str: str}`` dicts (the commonest thing to encode, for some
+        applications) take just one function call each.
+        """
+        if self.ensure_ascii:
+            encoder = encode_basestring_ascii
+        else:
+            encoder = encode_basestring
+        _encoding = self.encoding
+        _do_decode = (_encoding is not None
+            and not (_encoding == 'utf-8'))
+        allow_nan = self.allow_nan
+        skipkeys = self.skipkeys
+        sort_keys = self.sort_keys
+        item_separator = self.item_separator
+        key_separator = self.key_separator
+        default = self.default
+
+        def encode_list(lst):
+            if not lst:
+                append('[]')
+                return
+            if markers is not None:
+                markerid = id(lst)
+                if markerid in markers:
+                    raise ValueError("Circular reference detected")
+                markers[markerid] = lst
+            append('[')
+            first = True
+            for value in lst:
+                if first:
+                    first = False
+                else:
+                    append(item_separator)
+                if isinstance(value, basestring) and not _do_decode:
+                    append(encoder(value))
+                else:
+                    encode(value)
+            append(']')
+            if markers is not None:
+                del markers[markerid]
+
+        def encode_dict(dct):
+            if not dct:
+                append('{}')
+                return
+            if markers is not None:
+                markerid = id(dct)
+                if markerid in markers:
+                    raise ValueError("Circular reference detected")
+                markers[markerid] = dct
+            append('{')
+            if sort_keys:
+                keys = dct.keys()
+                keys.sort()
+                items = [(k, dct[k]) for k in keys]
+            else:
+                items = dct.iteritems()
+            first = True
+            for key, value in items:
+                if isinstance(key, str):
+                    if _do_decode:
+                        key = key.decode(_encoding)
+                elif isinstance(key, basestring):
+                    pass
+                elif isinstance(key, float):
+                    key = floatstr(key, allow_nan)
+                elif isinstance(key, (int, long)):
+                    key = str(key)
+                elif key is True:
+                    key = 'true'
+                elif key is False:
+                    key = 'false'
+                elif key is None:
+                    key = 'null'
+                elif skipkeys:
+                    continue
+                else:
+                    raise TypeError("key %r is not a string" % (key,))
+                if first:
+                    first = False
+                else:
+                    append(item_separator)
+                if isinstance(value, basestring) and not _do_decode:
+                    append(encoder(key) + key_separator + encoder(value))
+                else:
+                    append(encoder(key))
+                    append(key_separator)
+                    encode(value)
+            append('}')
+            if markers is not None:
+                del markers[markerid]
+
+        def encode(o):
+            if isinstance(o, basestring):
+                if _do_decode and isinstance(o, str):
+                    o = o.decode(_encoding)
+                append(encoder(o))
+            elif o is None:
+                append('null')
+            elif o is True:
+                append('true')
+            elif o is False:
+                append('false')
+            elif isinstance(o, (int, long)):
+                append(str(o))
+            elif isinstance(o, float):
+                append(floatstr(o, allow_nan))
+            elif isinstance(o, (list, tuple)):
+                encode_list(o)
+            elif isinstance(o, dict):
+                encode_dict(o)
+            else:
+                if markers is not None:
+                    markerid = id(o)
+                    if markerid in markers:
+                        raise ValueError("Circular reference detected")
+                    markers[markerid] = o
+                encode(default(o))
+                if markers is not None:
+                    del markers[markerid]
+
+        return encode
+
     def _iterencode_default(self, o, markers=None):
         newobj = self.default(o)
         return self._iterencode(newobj, markers)
@@ -360,6 +500,14 @@ class JSONEncoder(object):
                 return encode_basestring_ascii(o)
             else:
                 return encode_basestring(o)
+        if self.fast and self.indent is None:
+            chunks = []
+            if self.check_circular:
+                markers = {}
+            else:
+                markers = None
+            self._make_fast_encoder(chunks.append, markers)(o)
+            return ''.join(chunks)
         # This doesn't pass the iterator directly to ''.join() because the
         # exceptions aren't as detailed.  The list call should be roughly
         # equivalent to the PySequence_Fast that ''.join() would do.
@@ -375,7 +523,12 @@ class JSONEncoder(object):
             
             for chunk in JSONEncoder().iterencode(bigobject):
                 mysocket.write(chunk)
+
+        In fast mode (see ``__init__``), the whole encoding is done at once,
+        and given as a single chunk.
         """
+        if self.fast and self.indent is None:
+            return [self.encode(o)]
         if self.check_circular:
             markers = {}
         else:
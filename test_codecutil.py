@@ -0,0 +1,101 @@
+""" Unit tests for the codecutil module: all backends must agree on jobjs.
+"""
+import unittest
+import codecutil
+
+# payloads shaped like what jsonutil sends and receives
+_jobj = {'id': '12345', 'name': 'Dr. John 7', 'number': '555-1234',
+         'doctor': 'Doctor/12'}
+_payloads = [
+  {},
+  [],
+  _jobj,
+  [{'id': str(i)} for i in range(200)],
+  [dict(_jobj, id=str(i)) for i in range(50)],
+  {'id': '3', 'name': u'Dr. \xe9\u20ac\U0001d11e', 'doctor': None},
+  {'id': '4', 'name': 'quotes " and \\ and\ttabs\nand\x01ctl</script>'},
+  dict(_jobj, pagers=[{'id': '1', 'number': '5'}, {'id': '2'}]),
+  {'error': 'Item 1: Unknown property nome'},
+  {'hits': 10, 'misses': 3, 'hit_ratio': 0.76923076923076927,
+   'flag': True, 'other': False, 'big': 12345678901234567890L},
+  [None, True, False, 0, -1, 1.5, 1e100, '', u'', [[]], {'': {}}],
+]
+
+
+class TestCodecParity(unittest.TestCase):
+
+  def setUp(self):
+    self.backends = codecutil.backends()
+    self.selected = codecutil.name
+
+  def tearDown(self):
+    codecutil.use(self.selected)
+
+  def test_some_backend(self):
+    self.failUnless(self.backends)
+    self.failUnless(codecutil.name in [b[0] for b in self.backends])
+
+  def test_prefers_accelerated(self):
+    accelerated = [name for name, module, fast in self.backends if fast]
+    if accelerated:
+      self.assertEqual(self.selected, accelerated[0])
+    else:
+      self.assertEqual(self.selected, self.backends[0][0])
+
+  def test_dumps_identical(self):
+    for payload in _payloads:
+      texts = [(name, module.dumps(payload))
+               for name, module, fast in self.backends]
+      for name, text in texts[1:]:
+        self.assertEqual(text, texts[0][1], '%s vs %s on %r' % (
+            name, texts[0][0], payload))
+
+  def test_loads_identical(self):
+    for payload in _payloads:
+      text = codecutil.dumps(payload)
+      for name, module, fast in self.backends:
+        self.assertEqual(module.loads(text), payload,
+                         '%s on %r' % (name, text))
+
+  def test_loads_unicode_strings(self):
+    for name, module, fast in self.backends:
+      jobj = module.loads('{"id": "1", "name": "x"}')
+      for key, value in jobj.items():
+        self.failUnless(isinstance(key, unicode), name)
+        self.failUnless(isinstance(value, unicode), name)
+
+  def test_loads_invalid(self):
+    for name, module, fast in self.backends:
+      codecutil.use(name)
+      for text in ('', '{', '{"id": }', '[1,]x', "{'id': '1'}"):
+        self.assertRaises(ValueError, codecutil.loads, text)
+
+  def test_dump_as_dumps(self):
+    import StringIO
+    for name, module, fast in self.backends:
+      codecutil.use(name)
+      for payload in _payloads:
+        out = StringIO.StringIO()
+        codecutil.dump(payload, out)
+        self.assertEqual(out.getvalue(), codecutil.dumps(payload))
+
+  def test_dumps_as_backend(self):
+    for name, module, fast in self.backends:
+      codecutil.use(name)
+      for payload in _payloads:
+        self.assertEqual(codecutil.dumps(payload), module.dumps(payload))
+
+  def test_encode_string(self):
+    strings = ['', 'x', 'Dr. John 7', 'caf\xc3\xa9', u'\xe9\u20ac\U0001d11e',
+               '" \\ / \b \f \n \r \t \x01 </script>']
+    for name, module, fast in self.backends:
+      codecutil.use(name)
+      for s in strings:
+        self.assertEqual(codecutil.encode_string(s), codecutil.dumps(s))
+
+  def test_use_unknown(self):
+    self.assertRaises(KeyError, codecutil.use, 'nosuchjson')
+
+
+if __name__ == '__main__':
+  unittest.main()
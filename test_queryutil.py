@@ -0,0 +1,96 @@
+""" Unit tests for the queryutil module's composite-index logic.
+"""
+import unittest
+import queryutil
+from queryutil import BadQueryError, is_declared, required_index
+
+
+class TestRequiredIndex(unittest.TestCase):
+
+  def test_builtin_indexes(self):
+    # no filters or orders, equalities only, a single order, inequalities
+    # on one property (sorted on or not): all served w/o composite index
+    self.assertEqual(required_index([]), None)
+    self.assertEqual(required_index([('a', '=', 1), ('b', '=', 2)]), None)
+    self.assertEqual(required_index([], [('a', 'desc')]), None)
+    self.assertEqual(required_index([('a', '>', 1), ('a', '<=', 5)]), None)
+    self.assertEqual(required_index([('a', '>', 1)], [('a', 'desc')]), None)
+
+  def test_several_orders(self):
+    self.assertEqual(required_index([], [('a', 'asc'), ('b', 'desc')]),
+                     (frozenset(), (('a', 'asc'), ('b', 'desc'))))
+
+  def test_equality_and_order(self):
+    self.assertEqual(required_index([('a', '=', 1)], [('b', 'desc')]),
+                     (frozenset(['a']), (('b', 'desc'),)))
+
+  def test_orders_on_equalities_ignored(self):
+    self.assertEqual(required_index([('a', '=', 1)], [('a', 'desc')]), None)
+    self.assertEqual(required_index([('a', '=', 1)],
+                                    [('a', 'asc'), ('b', 'asc')]),
+                     (frozenset(['a']), (('b', 'asc'),)))
+    # ...even before checking the inequality property is sorted on first
+    self.assertEqual(required_index([('c', '=', 1), ('a', '>', 2)],
+                                    [('c', 'asc'), ('a', 'desc')]),
+                     (frozenset(['c']), (('a', 'desc'),)))
+
+  def test_equality_and_inequality(self):
+    # the inequality property is implicitly sorted on, ascending
+    self.assertEqual(required_index([('a', '=', 1), ('b', '>=', 2)]),
+                     (frozenset(['a']), (('b', 'asc'),)))
+    self.assertEqual(required_index([('b', '>=', 2), ('a', '=', 1),
+                                     ('c', '=', 3)]),
+                     (frozenset(['a', 'c']), (('b', 'asc'),)))
+
+  def test_inequality_then_other_orders(self):
+    self.assertEqual(required_index([('a', '>', 1)],
+                                    [('a', 'asc'), ('b', 'desc')]),
+                     (frozenset(), (('a', 'asc'), ('b', 'desc'))))
+
+  def test_inequalities_on_two_properties(self):
+    self.assertRaises(BadQueryError, required_index,
+                      [('a', '>', 1), ('b', '<', 2)])
+
+  def test_inequality_not_sorted_first(self):
+    self.assertRaises(BadQueryError, required_index,
+                      [('a', '>', 1)], [('b', 'asc')])
+    self.assertRaises(BadQueryError, required_index,
+                      [('a', '>', 1)], [('b', 'asc'), ('a', 'asc')])
+
+
+class TestIsDeclared(unittest.TestCase):
+
+  def setUp(self):
+    # as declared_indexes would parse them from an index.yaml
+    queryutil._declared = [
+      ('Doctor', (('name', 'asc'), ('number', 'desc'))),
+      ('Pager', (('b', 'asc'), ('a', 'asc'), ('c', 'desc'))),
+    ]
+
+  def tearDown(self):
+    queryutil._declared = None
+
+  def test_matching(self):
+    self.failUnless(is_declared('Doctor',
+                                (frozenset(['name']), (('number', 'desc'),))))
+    self.failUnless(is_declared('Doctor',
+        (frozenset(), (('name', 'asc'), ('number', 'desc')))))
+
+  def test_equalities_in_any_order(self):
+    self.failUnless(is_declared('Pager',
+                                (frozenset(['a', 'b']), (('c', 'desc'),))))
+
+  def test_not_matching(self):
+    index = frozenset(['name']), (('number', 'desc'),)
+    self.failIf(is_declared('Pager', index))
+    self.failIf(is_declared('Doctor',
+                            (frozenset(['name']), (('number', 'asc'),))))
+    self.failIf(is_declared('Doctor',
+                            (frozenset(['number']), (('name', 'asc'),))))
+    self.failIf(is_declared('Doctor', (frozenset(), (('number', 'desc'),))))
+    self.failIf(is_declared('Pager',
+                            (frozenset(['a']), (('b', 'asc'), ('c', 'desc')))))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,129 @@
+""" Unit tests for the speedups made to the bundled simplejson package.
+"""
+import unittest
+import simplejson
+from simplejson.decoder import JSONDecoder
+from simplejson.encoder import JSONEncoder
+
+_docs = [
+  '{}', '[]', ' {} ', '""', '"x"', '0', '-0', '12', '-12', '1.5', '-1.5e10',
+  '1E-3', 'true', 'false', 'null', 'NaN', 'Infinity', '-Infinity',
+  '{"id": "12", "name": "Dr. John 7", "number": "555-1234"}',
+  '[{"id": "1"}, {"id": "2"}, {"id": "3"}]',
+  '\n[ {"a" : [ 1 , 2.5 , [ ] , { } ] ,"b":{"c":{"d":null}}} ]\t',
+  '"esc \\" \\\\ \\/ \\b \\f \\n \\r \\t \\u00e9 \\ud834\\udd1e"',
+  '{"nested": [[[[["deep"]]]]], "u": "\\u20ac"}',
+  '[12345678901234567890, -1, 0.1]',
+]
+
+_bad_docs = [
+  '', ' ', '{', '[', '{"a"}', '{"a":}', '{"a": 1,}', '[1,]', '[1 2]',
+  '{a: 1}', "{'a': 1}", '"unterminated', '"bad \\x escape"', 'nul', 'tru',
+  '01', '-', '1.', '.5', '[1] x', '"ctl \x01 char"',
+]
+
+
+class TestFastDecoder(unittest.TestCase):
+
+  def setUp(self):
+    self.fast = JSONDecoder()
+    self.slow = JSONDecoder(fast=False)
+
+  def test_fast_is_default(self):
+    self.failUnless(self.fast.scan_once is not None)
+    self.failUnless(self.slow.scan_once is None)
+
+  def test_same_results(self):
+    for doc in _docs:
+      fast = self.fast.decode(doc)
+      self.assertEqual(repr(fast), repr(self.slow.decode(doc)), doc)
+      self.assertEqual(repr(fast), repr(simplejson.loads(doc)), doc)
+
+  def test_same_errors(self):
+    for doc in _bad_docs:
+      self.assertRaises(ValueError, self.fast.decode, doc)
+      self.assertRaises(ValueError, self.slow.decode, doc)
+
+  def test_raw_decode(self):
+    self.assertEqual(self.fast.raw_decode('[1, 2] [3]'), ([1, 2], 6))
+    self.assertEqual(self.fast.raw_decode('[1, 2] [3]', idx=7), ([3], 10))
+
+  def test_options(self):
+    import decimal
+    seen = []
+    def hook(d):
+      seen.append(d)
+      return sorted(d.items())
+    decoder = JSONDecoder(object_hook=hook, parse_float=decimal.Decimal,
+                          parse_int=float, parse_constant=repr)
+    result = decoder.decode('{"a": [1, 1.5, null, {"b": true}]}')
+    self.assertEqual(result, [(u'a', [1.0, decimal.Decimal('1.5'), "'null'",
+                                      [(u'b', "'true'")]])])
+    self.assertEqual(len(seen), 2)
+    self.assertEqual(decoder.decode('{}'), [])
+    self.assertEqual(simplejson.loads('[1.5]', parse_float=str), ['1.5'])
+
+
+_objs = [
+  {}, [], (), '', u'', 'x', 0, -1, 12345678901234567890L, 1.5, 1e100,
+  float('nan'), float('inf'), -float('inf'), None, True, False,
+  {'id': '12', 'name': 'Dr. John 7', 'number': '555-1234'},
+  [{'id': str(i)} for i in range(20)],
+  {'id': '3', 'name': u'Dr. \xe9\u20ac\U0001d11e', 'raw': 'caf\xc3\xa9'},
+  {'esc': '" \\ / \b \f \n \r \t \x01 </script>'},
+  {'a': [1, 2.5, [], {}, (3, 4)], 'b': {'c': {'d': None}}},
+  {1: 'int', 2.5: 'float', True: 'bool', None: 'none', u'k': [None]},
+]
+
+
+class TestFastEncoder(unittest.TestCase):
+
+  def _both(self, **kw):
+    return JSONEncoder(**kw), JSONEncoder(fast=False, **kw)
+
+  def test_same_text(self):
+    for kw in ({}, dict(check_circular=False), dict(sort_keys=True),
+               dict(separators=(',', ':')), dict(ensure_ascii=False)):
+      fast, slow = self._both(**kw)
+      for obj in _objs:
+        if kw.get('ensure_ascii') is False and 'raw' in repr(obj):
+          continue
+        self.assertEqual(fast.encode(obj), slow.encode(obj), (kw, obj))
+        self.assertEqual(''.join(fast.iterencode(obj)),
+                         ''.join(slow.iterencode(obj)), (kw, obj))
+
+  def test_dumps(self):
+    for obj in _objs:
+      self.assertEqual(simplejson.dumps(obj),
+                       JSONEncoder(fast=False).encode(obj))
+
+  def test_indent_falls_back(self):
+    fast, slow = self._both(indent=2)
+    for obj in _objs:
+      self.assertEqual(fast.encode(obj), slow.encode(obj))
+
+  def test_circular(self):
+    loop = []
+    loop.append(loop)
+    self.assertRaises(ValueError, JSONEncoder().encode, loop)
+    loop = {}
+    loop['self'] = loop
+    self.assertRaises(ValueError, JSONEncoder().encode, loop)
+
+  def test_errors(self):
+    fast, slow = self._both()
+    self.assertRaises(TypeError, fast.encode, object())
+    self.assertRaises(TypeError, fast.encode, {(1, 2): 'tuple key'})
+    self.assertRaises(ValueError, JSONEncoder(allow_nan=False).encode,
+                      [float('nan')])
+    self.assertEqual(JSONEncoder(skipkeys=True).encode({(1, 2): 'x', 'a': 1}),
+                     '{"a": 1}')
+
+  def test_default(self):
+    fast, slow = self._both(default=lambda o: sorted(o))
+    obj = {'set': set([3, 1, 2])}
+    self.assertEqual(fast.encode(obj), slow.encode(obj))
+
+
+if __name__ == '__main__':
+  unittest.main()
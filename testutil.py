@@ -4,21 +4,25 @@ import cookielib
 import httplib
 import optparse
 import os
+import re
 import signal
 import socket
 import subprocess
 import sys
 import time
 import urllib2
-import simplejson
+import codecutil
 
 
 DEFAULT_HOST = 'localhost'
 DEFAULT_PORT = 8080
 DEFAULT_PREFIX = ''
 
+# RE to match the URL of a Link header's rel="next" item
+LINK_NEXT_RE = re.compile(r'<([^>]*)>\s*;\s*rel="?next"?')
+
 def body(**k):
-  return simplejson.dumps(k)
+  return codecutil.dumps(k)
 
 
 class Tester(object):
@@ -91,6 +95,8 @@ class Tester(object):
       print 'Cannot request %r %r: %s' % (verb, path, e)
       sys.exit(1)
     rl = self.conn.getresponse()
+    self.last_headers = dict(rl.getheaders())
+    self.last_reason = rl.reason
     if self.verbose or rl.status//100 != 2:
       print '%s %s gave: %s %r' % (verb, path, rl.status, rl.reason)
     if rl.status//100 == 2:
@@ -103,10 +109,40 @@ class Tester(object):
         for line in body.splitlines():
           print ' ', line
         print
-      return simplejson.loads(body)
+      return codecutil.loads(body)
     else:
       return None
 
+  def request_all_pages(self, path, limit=None):
+    """ GETs a paged collection, following its rel="next" Link headers.
+
+        Shows data about the interactions just like request_and_show does.
+        Returns the list of all items in all pages, or None if any GET fails.
+    """
+    if limit is not None:
+      path = '%s?limit=%d' % (path, limit)
+    items = []
+    while path is not None:
+      page = self.request_and_show('GET', path)
+      if page is None: return None
+      items.extend(page)
+      mo = LINK_NEXT_RE.search(self.last_headers.get('link', ''))
+      if mo is None:
+        path = None
+      else:
+        # the link's path starts with our prefix, which request_and_show adds
+        path = mo.group(1)
+        if path.startswith(self.prefix): path = path[len(self.prefix):]
+    return items
+
+  def silent_request_all_pages(self, path, limit=None):
+    """ Like request_all_pages, but always silently. """
+    prev = self.verbose
+    self.verbose = False
+    retval = self.request_all_pages(path, limit)
+    self.verbose = prev
+    return retval
+
   def get_cookies(self):
     opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cj))
     opener.open("http://%s:%s" % (self.host, self.port))